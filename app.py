@@ -1,27 +1,46 @@
 import os
+import json
+import time
+import hashlib
 import uuid
+import random
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from functools import partial
 
 from dotenv import load_dotenv
 load_dotenv()
 import colorsys
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, flash, session, send_from_directory
+    url_for, flash, session, send_from_directory,
+    g, has_request_context, abort, Response, stream_with_context, jsonify
 )
 import re
+from functools import wraps
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import (
     LoginManager, login_user, logout_user,
     login_required, current_user, UserMixin
 )
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
-from PIL import Image
+from PIL import Image, features
+import click
 import requests
-from sqlalchemy import func
+from requests.adapters import HTTPAdapter
+from sqlalchemy import func, or_, and_, case, event, inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import selectinload
 
 # ----------------- 基础配置 -----------------
 
@@ -38,11 +57,70 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 UPLOAD_ROOT = os.path.join('static', 'uploads')
 app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, UPLOAD_ROOT)
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB
+# 上传原图先写入暂存目录，再由后台进程池生成各尺寸图片
+app.config['UPLOAD_STAGING_FOLDER'] = os.path.join(BASE_DIR, 'upload_staging')
+app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', '2'))
+# 菜品图片响应式变体：宽度列表、WebP 质量，可选 AVIF（需要 Pillow 支持）
+app.config['DISH_IMAGE_WIDTHS'] = [int(w) for w in os.getenv('DISH_IMAGE_WIDTHS', '200,400,800').split(',')]
+app.config['DISH_IMAGE_WEBP_QUALITY'] = int(os.getenv('DISH_IMAGE_WEBP_QUALITY', '80'))
+app.config['DISH_IMAGE_AVIF'] = os.getenv('DISH_IMAGE_AVIF', '0') == '1'
+app.config['DISH_IMAGE_AVIF_QUALITY'] = int(os.getenv('DISH_IMAGE_AVIF_QUALITY', '60'))
+# 设为 1 时在请求内同步处理（调试用）
+app.config['IMAGE_PROCESSING_SYNC'] = os.getenv('IMAGE_PROCESSING_SYNC', '0') == '1'
+# 上传图片通过带指纹的 /media 地址提供，可长期缓存；
+# 前面有 Apache/lighttpd 时开启 X-Sendfile，有 nginx 时设置 internal location 前缀走 X-Accel-Redirect
+app.config['MEDIA_MAX_AGE'] = int(os.getenv('MEDIA_MAX_AGE', str(365 * 24 * 3600)))
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '0') == '1'
+app.config['MEDIA_ACCEL_PREFIX'] = os.getenv('MEDIA_ACCEL_PREFIX', '').rstrip('/')
 
 # GPT 配置（从 .env 读取）
 GPT_BASE_URL = os.getenv('GPT_BASE_URL', '')
 GPT_API_KEY = os.getenv('GPT_API_KEY', '')
 GPT_MODEL = os.getenv('GPT_MODEL', 'gpt-4o')
+GPT_POOL_SIZE = int(os.getenv('GPT_POOL_SIZE', '10'))
+GPT_CONNECT_TIMEOUT = float(os.getenv('GPT_CONNECT_TIMEOUT', '5'))
+GPT_READ_TIMEOUT = float(os.getenv('GPT_READ_TIMEOUT', '30'))
+GPT_MAX_RETRIES = int(os.getenv('GPT_MAX_RETRIES', '2'))
+GPT_RETRY_BACKOFF = float(os.getenv('GPT_RETRY_BACKOFF', '0.5'))
+GPT_MAX_BACKOFF = float(os.getenv('GPT_MAX_BACKOFF', '10'))
+
+# 统计快照缓存：memory（进程内 LRU）或 redis（多进程共享）
+app.config['STATS_CACHE_BACKEND'] = os.getenv('STATS_CACHE_BACKEND', 'memory')
+app.config['STATS_CACHE_TTL'] = int(os.getenv('STATS_CACHE_TTL', '300'))
+app.config['STATS_CACHE_MAX_ENTRIES'] = int(os.getenv('STATS_CACHE_MAX_ENTRIES', '1024'))
+app.config['REDIS_URL'] = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+# 购物车存储：sql（数据库 cart_item 表）、redis（多进程共享）或 memory（单进程调试）
+app.config['CART_BACKEND'] = os.getenv('CART_BACKEND', 'sql')
+
+# 智能问答答案缓存：相同模型、提示词、统计快照和问题直接复用答案
+app.config['ANSWER_CACHE_TTL'] = int(os.getenv('ANSWER_CACHE_TTL', '3600'))
+app.config['ANSWER_CACHE_MAX_ENTRIES'] = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '2048'))
+
+# 智能问答后台任务：全局工作线程数、最大排队数、单个餐厅同时进行的任务数、结果保留秒数
+app.config['ADVISOR_WORKERS'] = int(os.getenv('ADVISOR_WORKERS', '4'))
+app.config['ADVISOR_QUEUE_SIZE'] = int(os.getenv('ADVISOR_QUEUE_SIZE', '32'))
+app.config['ADVISOR_PER_RESTAURANT'] = int(os.getenv('ADVISOR_PER_RESTAURANT', '2'))
+app.config['ADVISOR_JOB_TTL'] = int(os.getenv('ADVISOR_JOB_TTL', '600'))
+
+# AI 回答渲染结果缓存条数
+app.config['FORMAT_CACHE_MAX_ENTRIES'] = int(os.getenv('FORMAT_CACHE_MAX_ENTRIES', '1024'))
+
+# 黑名单缓存（秒）：大于 0 时每个进程缓存各餐厅的黑名单 id 集合，拉黑 / 取消时清除本进程缓存，
+# 其他进程最多延迟这么久生效；0 表示每次都查数据库
+app.config['BLACKLIST_CACHE_TTL'] = int(os.getenv('BLACKLIST_CACHE_TTL', '0'))
+app.config['BLACKLIST_CACHE_MAX_ENTRIES'] = int(os.getenv('BLACKLIST_CACHE_MAX_ENTRIES', '1024'))
+
+# 登录用户缓存（秒）：每个进程缓存用户 id、用户名、头像和餐厅 id，0 表示每次请求都查库
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', '30'))
+app.config['USER_CACHE_MAX_ENTRIES'] = int(os.getenv('USER_CACHE_MAX_ENTRIES', '4096'))
+
+# 下架菜品的订单项在订单超过这么多天后由 archive-orders 移入 order_item_history
+app.config['ORDER_ARCHIVE_AFTER_DAYS'] = int(os.getenv('ORDER_ARCHIVE_AFTER_DAYS', '90'))
+
+# 餐厅列表分页
+app.config['RESTAURANTS_PER_PAGE'] = int(os.getenv('RESTAURANTS_PER_PAGE', '24'))
+app.config['RESTAURANTS_MAX_PER_PAGE'] = 100
 
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
@@ -51,39 +129,59 @@ login_manager.login_view = 'login'
 
 # ----------------- 自定义模板过滤器 -----------------
 
+# format_ai_answer 用到的正则全部预编译
+_AI_BR_RE = re.compile(r'<br\s*/?>', re.IGNORECASE)
+_AI_HR_RE = re.compile(r'-{3,}|\*{3,}')
+_AI_HEADINGS = (('#### ', 'h6'), ('### ', 'h5'), ('## ', 'h4'), ('# ', 'h3'))
+_AI_UL_ITEM_RE = re.compile(r'^(\s*)[-*]\s+(.+)$')
+# 中文序号（一、二、三等）作为标题处理，不是列表；注意 \s 可以跨行匹配
+_AI_CN_TITLE_RE = re.compile(r'^(\s*)([一二三四五六七八九十]+)[、.]\s+(.+)$', re.MULTILINE)
+_AI_OL_ITEM_RE = re.compile(r'^(\s*)(\d+)\.\s+(.+)$')
+_AI_OL_NEXT_RE = re.compile(r'^(\s*)(\d+)\.\s+')
+_AI_BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+_AI_ITALIC_RE = re.compile(r'(?<!\*)\*(?![*<])([^*<]+?)(?<![*<])\*(?!\*)')
+# 整体转义后再把我们需要的标签还原回来；块级元素后面补一个换行，便于后面按行加 <br>
+_AI_TAG_RE = re.compile(r'&lt;(?:hr|/?(?:h[3-6]|ul|ol|li|strong|em))&gt;')
+_AI_BLOCK_ENDS = {'<hr>', '</h3>', '</h4>', '</h5>', '</h6>', '</ul>', '</ol>'}
+_AI_BLOCK_STARTS = ('<hr>', '<h3>', '<h4>', '<h5>', '<h6>', '<ul>', '<ol>', '</ul>', '</ol>')
+_AI_BR_BEFORE_BLOCK_RE = re.compile(r'<br>\s*(<hr>|<h[3-6]>|<ul>|<ol>)')
+_AI_BR_AFTER_BLOCK_RE = re.compile(r'(</h[3-6]>|</ul>|</ol>)\s*<br>')
+
+
+def _restore_ai_tag(match):
+    tag = '<' + match.group(0)[4:-4] + '>'
+    return tag + '\n' if tag in _AI_BLOCK_ENDS else tag
+
+
 def format_ai_answer(text):
     """格式化AI回答，处理换行、HTML标签和Markdown格式"""
     if not text:
         return ''
     text = str(text)
     # 先移除文本中可能存在的 <br> 标签（作为纯文本），转换为换行符
-    text = re.sub(r'<br\s*/?>', '\n', text, flags=re.IGNORECASE)
-    
-    # 处理markdown分隔线 --- 或 ***（必须在其他处理之前）
-    text = re.sub(r'^---+$', '<hr>', text, flags=re.MULTILINE)
-    text = re.sub(r'^\*{3,}$', '<hr>', text, flags=re.MULTILINE)
-    
-    # 处理markdown标题 # ## ### 等（必须在转义HTML之前）
-    text = re.sub(r'^#### (.+?)$', r'<h6>\1</h6>', text, flags=re.MULTILINE)
-    text = re.sub(r'^### (.+?)$', r'<h5>\1</h5>', text, flags=re.MULTILINE)
-    text = re.sub(r'^## (.+?)$', r'<h4>\1</h4>', text, flags=re.MULTILINE)
-    text = re.sub(r'^# (.+?)$', r'<h3>\1</h3>', text, flags=re.MULTILINE)
-    
-    # 处理markdown无序列表 - 或 *（必须在转义HTML之前）
-    # 先处理多级列表，按行处理
-    lines = text.split('\n')
-    in_list = False
+    if '<' in text:
+        text = _AI_BR_RE.sub('\n', text)
+
+    # 第一遍按行处理：分隔线 --- / ***、标题 # ## ### ####、无序列表 - / *
     result_lines = []
-    for line in lines:
-        # 检查是否是列表项
-        list_match = re.match(r'^(\s*)[-*]\s+(.+)$', line)
+    in_list = False
+    for line in text.split('\n'):
+        if _AI_HR_RE.fullmatch(line):
+            line = '<hr>'
+        elif line.startswith('#'):
+            for prefix, tag in _AI_HEADINGS:
+                if line.startswith(prefix) and len(line) > len(prefix):
+                    line = f'<{tag}>{line[len(prefix):]}</{tag}>'
+                    break
+
+        # 先用首字符快速排除，绝大多数普通行不需要跑正则
+        first = line[:1]
+        list_match = (first in ('-', '*') or first.isspace()) and _AI_UL_ITEM_RE.match(line)
         if list_match:
-            indent = len(list_match.group(1))
-            content = list_match.group(2)
             if not in_list:
                 result_lines.append('<ul>')
                 in_list = True
-            result_lines.append(f'<li>{content}</li>')
+            result_lines.append(f'<li>{list_match.group(2)}</li>')
         else:
             if in_list:
                 result_lines.append('</ul>')
@@ -92,163 +190,119 @@ def format_ai_answer(text):
     if in_list:
         result_lines.append('</ul>')
     text = '\n'.join(result_lines)
-    
-    # 处理中文序号（一、二、三、四等）- 作为标题处理，不是列表
-    # 将"一、xxx"格式转换为标题格式
-    chinese_numbers = {
-        '一': '1', '二': '2', '三': '3', '四': '4', '五': '5',
-        '六': '6', '七': '7', '八': '8', '九': '9', '十': '10',
-        '十一': '11', '十二': '12', '十三': '13', '十四': '14', '十五': '15'
-    }
-    
-    def convert_chinese_title(match):
-        chinese = match.group(1)
-        content = match.group(2)
-        return f'<h4>{content}</h4>'
-    
+
     # 将"一、xxx"格式转换为标题（不作为列表项）
-    text = re.sub(r'^(\s*)([一二三四五六七八九十]+)[、.]\s+(.+)$', convert_chinese_title, text, flags=re.MULTILINE)
-    
-    # 处理markdown有序列表 1. 2. 等
-    # 只处理连续的数字序号列表，确保是真正的列表项
+    text = _AI_CN_TITLE_RE.sub(lambda m: f'<h4>{m.group(2)}</h4>', text)
+
+    # 第二遍按行处理：有序列表 1. 2. 等，只处理从 1 开始、连续编号且不缩进的列表项
     lines = text.split('\n')
     in_ordered_list = False
     result_lines = []
     last_list_number = 0
-    
+
     for i, line in enumerate(lines):
-        # 检查是否是有序列表项（数字开头）
-        ordered_match = re.match(r'^(\s*)(\d+)\.\s+(.+)$', line)
+        first = line[:1]
+        ordered_match = (first.isdecimal() or first.isspace()) and _AI_OL_ITEM_RE.match(line)
         is_empty = not line.strip()
-        
+
         if ordered_match:
             indent = len(ordered_match.group(1))
             list_number = int(ordered_match.group(2))
-            content = ordered_match.group(3)
-            
+
             # 判断是否是连续列表项（允许从1开始，或者比上一个数字大1）
             is_continuous = (not in_ordered_list and list_number == 1) or \
                           (in_ordered_list and list_number == last_list_number + 1)
-            
-            # 如果缩进为0且数字连续，才认为是列表项
+
             if indent == 0 and is_continuous:
                 if not in_ordered_list:
                     result_lines.append('<ol>')
                     in_ordered_list = True
-                result_lines.append(f'<li>{content}</li>')
+                result_lines.append(f'<li>{ordered_match.group(3)}</li>')
                 last_list_number = list_number
             else:
-                # 不是连续列表项，关闭之前的列表（如果有）
                 if in_ordered_list:
                     result_lines.append('</ol>')
                     in_ordered_list = False
                     last_list_number = 0
                 result_lines.append(line)
-        else:
-            # 如果当前在列表中，需要判断是否关闭列表
-            if in_ordered_list:
-                # 检查下一行是否是连续列表项（允许中间有一个空行）
-                next_is_list = False
-                next_list_num = 0
-                if i + 1 < len(lines):
-                    next_line = lines[i + 1]
-                    next_match = re.match(r'^(\s*)(\d+)\.\s+', next_line)
-                    if next_match and len(next_match.group(1)) == 0:
-                        next_list_num = int(next_match.group(2))
-                        next_is_list = (next_list_num == last_list_number + 1)
-                
-                # 如果当前是空行，但下一行是连续列表项，则保留空行但继续列表
-                if is_empty and next_is_list:
-                    result_lines.append('')
-                else:
-                    # 关闭列表
-                    result_lines.append('</ol>')
-                    in_ordered_list = False
-                    last_list_number = 0
-                    if not is_empty:
-                        result_lines.append(line)
+        elif in_ordered_list:
+            # 检查下一行是否是连续列表项（允许中间有一个空行）
+            next_is_list = False
+            if is_empty and i + 1 < len(lines):
+                next_match = _AI_OL_NEXT_RE.match(lines[i + 1])
+                if next_match and not next_match.group(1):
+                    next_is_list = int(next_match.group(2)) == last_list_number + 1
+
+            if next_is_list:
+                result_lines.append('')
             else:
-                result_lines.append(line)
-    
+                result_lines.append('</ol>')
+                in_ordered_list = False
+                last_list_number = 0
+                if not is_empty:
+                    result_lines.append(line)
+        else:
+            result_lines.append(line)
+
     if in_ordered_list:
         result_lines.append('</ol>')
     text = '\n'.join(result_lines)
-    
-    # 处理markdown格式的粗体 **text**（必须在转义HTML之前）
-    text = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', text)
-    # 处理markdown格式的斜体 *text*（但避免与粗体冲突）
-    text = re.sub(r'(?<!\*)\*(?![*<])([^*<]+?)(?<![*<])\*(?!\*)', r'<em>\1</em>', text)
-    
-    # 转义所有HTML标签（除了我们已经添加的标签）
-    # 先转义 & 符号（必须在其他转义之前，但要避免重复转义）
-    text = text.replace('&amp;', '___AMP___')  # 保护已转义的&
-    text = text.replace('&', '&amp;')
-    text = text.replace('___AMP___', '&amp;')
-    
-    # 转义 < 和 >，但保留我们需要的标签
-    # 先保护我们需要的标签
-    protected_tags = [
-        ('<hr>', '___HR___'),
-        ('<h3>', '___H3_START___'), ('</h3>', '___H3_END___'),
-        ('<h4>', '___H4_START___'), ('</h4>', '___H4_END___'),
-        ('<h5>', '___H5_START___'), ('</h5>', '___H5_END___'),
-        ('<h6>', '___H6_START___'), ('</h6>', '___H6_END___'),
-        ('<ul>', '___UL_START___'), ('</ul>', '___UL_END___'),
-        ('<ol>', '___OL_START___'), ('</ol>', '___OL_END___'),
-        ('<li>', '___LI_START___'), ('</li>', '___LI_END___'),
-        ('<strong>', '___STRONG_START___'), ('</strong>', '___STRONG_END___'),
-        ('<em>', '___EM_START___'), ('</em>', '___EM_END___'),
-    ]
-    
-    for original, placeholder in protected_tags:
-        text = text.replace(original, placeholder)
-    
-    # 转义所有剩余的 < 和 >
+
+    # 粗体 **text** 和斜体 *text*（避免与粗体冲突）
+    if '*' in text:
+        text = _AI_BOLD_RE.sub(r'<strong>\1</strong>', text)
+        text = _AI_ITALIC_RE.sub(r'<em>\1</em>', text)
+
+    # 转义 HTML（已经转义过的 &amp; 不重复转义），再还原我们生成的标签
+    text = text.replace('&amp;', '&').replace('&', '&amp;')
     text = text.replace('<', '&lt;').replace('>', '&gt;')
-    
-    # 恢复我们需要的标签
-    for original, placeholder in protected_tags:
-        text = text.replace(placeholder, original)
-    
-    # 将换行符转换为 <br>，但保留块级元素之间的换行
-    # 先标记块级元素
-    text = text.replace('<hr>', '<hr>\n')
-    text = text.replace('</h3>', '</h3>\n')
-    text = text.replace('</h4>', '</h4>\n')
-    text = text.replace('</h5>', '</h5>\n')
-    text = text.replace('</h6>', '</h6>\n')
-    text = text.replace('</ul>', '</ul>\n')
-    text = text.replace('</ol>', '</ol>\n')
-    
+    text = _AI_TAG_RE.sub(_restore_ai_tag, text)
+
     # 将换行符转换为 <br>，但跳过空行（在块级元素之间）
-    lines = text.split('\n')
     result_lines = []
     prev_was_block = False
-    for line in lines:
+    for line in text.split('\n'):
         stripped = line.strip()
-        is_block = stripped.startswith(('<hr>', '<h3>', '<h4>', '<h5>', '<h6>', '<ul>', '<ol>', '</ul>', '</ol>'))
         if not stripped:
             if not prev_was_block:
                 result_lines.append('<br>')
-        elif is_block:
+        elif stripped.startswith(_AI_BLOCK_STARTS):
             result_lines.append(line)
             prev_was_block = True
         else:
             result_lines.append(line + '<br>')
             prev_was_block = False
-    
+
     text = '\n'.join(result_lines)
     # 清理多余的 <br> 标签（在块级元素前后）
-    text = re.sub(r'<br>\s*(<hr>|<h[3-6]>|<ul>|<ol>)', r'\1', text)
-    text = re.sub(r'(</h[3-6]>|</ul>|</ol>)\s*<br>', r'\1', text)
-    
+    text = _AI_BR_BEFORE_BLOCK_RE.sub(r'\1', text)
+    text = _AI_BR_AFTER_BLOCK_RE.sub(r'\1', text)
+
     return text
 
 
 @app.template_filter('format_ai')
 def format_ai_filter(text):
-    """Jinja2过滤器：格式化AI回答"""
-    return format_ai_answer(text)
+    """Jinja2过滤器：格式化AI回答（带缓存）"""
+    return render_ai_answer(text)
+
+
+UPLOAD_URL_PREFIX = 'uploads/'
+
+
+def media_fingerprint(filename):
+    """地址里的短指纹。上传文件写入后不再覆盖：新上传按原图摘要命名，重新生成的派生图换新文件名，
+    文件名本身就能区分版本，因此直接由文件名计算，渲染时不读磁盘，多台机器结果一致"""
+    return hashlib.blake2b(filename.encode(), digest_size=4).hexdigest()
+
+
+@app.template_global()
+def media_url(path):
+    """上传图片的访问地址（path 为数据库中相对 static 的路径）"""
+    if not path.startswith(UPLOAD_URL_PREFIX):
+        return url_for('static', filename=path)
+    filename = path[len(UPLOAD_URL_PREFIX):]
+    return url_for('media', fingerprint=media_fingerprint(filename), filename=filename)
 
 
 # ----------------- 数据模型 -----------------
@@ -266,6 +320,8 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(120), unique=True)
     password_hash = db.Column(db.String(128), nullable=False)
     avatar = db.Column(db.String(255))  # 相对 static 路径
+    avatar_status = db.Column(db.String(16))  # 图片处理状态：pending / ready / failed
+    avatar_job = db.Column(db.String(64))  # 处理中的暂存文件名，结果只在仍一致时回写
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     # 一个用户最多拥有一家餐厅
@@ -280,15 +336,23 @@ class User(UserMixin, db.Model):
 
 
 class Restaurant(db.Model):
+    __table_args__ = (
+        # 一个用户最多拥有一家餐厅；登录时按 owner_id 关联查询
+        db.Index('ix_restaurant_owner', 'owner_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
     logo = db.Column(db.String(255))  # 相对 static 路径
+    logo_status = db.Column(db.String(16))  # 图片处理状态：pending / ready / failed
+    logo_job = db.Column(db.String(64))  # 处理中的暂存文件名，结果只在仍一致时回写
     owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     categories = db.relationship('Category', backref='restaurant', lazy=True, cascade='all, delete-orphan')
     dishes = db.relationship('Dish', backref='restaurant', lazy=True, cascade='all, delete-orphan')
     orders = db.relationship('Order', backref='restaurant', lazy=True, cascade='all, delete-orphan')
+    revenue_summary = db.relationship('RestaurantRevenue', uselist=False, cascade='all, delete-orphan')
 
     blacklisted_users = db.relationship(
         'User',
@@ -298,6 +362,10 @@ class Restaurant(db.Model):
 
 
 class Category(db.Model):
+    __table_args__ = (
+        db.Index('ix_category_restaurant', 'restaurant_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
     restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), nullable=False)
@@ -305,20 +373,43 @@ class Category(db.Model):
 
 
 class Dish(db.Model):
+    __table_args__ = (
+        db.Index('ix_dish_restaurant', 'restaurant_id'),
+        db.Index('ix_dish_category', 'category_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
     description = db.Column(db.Text)
     price = db.Column(db.Numeric(10, 2), nullable=False)
     image = db.Column(db.String(255))   # 大图
     thumb = db.Column(db.String(255))   # 缩略图 <= 100*100
+    image_status = db.Column(db.String(16))  # 图片处理状态：pending / ready / failed
+    image_job = db.Column(db.String(64))  # 处理中的暂存文件名，结果只在仍一致时回写
+    # 响应式图片清单（JSON）：{"webp": [[宽度, 路径], ...], "avif": [...]}
+    image_variants = db.Column(db.Text)
     restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # 下架时间：下架后菜单和菜品管理中不再显示，历史订单保留
+    archived_at = db.Column(db.DateTime)
 
     order_items = db.relationship('OrderItem', backref='dish', lazy=True)
 
+    def image_srcset(self, fmt):
+        """返回某种格式的 srcset 字符串，没有该格式的变体时返回空字符串"""
+        variants = json.loads(self.image_variants or '{}').get(fmt, [])
+        return ', '.join(f"{media_url(path)} {width}w" for width, path in variants)
+
 
 class Order(db.Model):
+    __table_args__ = (
+        # 报表、顾客列表按餐厅筛选，按时间排序 / 截取
+        db.Index('ix_order_restaurant_created', 'restaurant_id', 'created_at'),
+        # 顾客历史：某顾客在某餐厅的订单
+        db.Index('ix_order_customer_restaurant', 'customer_id', 'restaurant_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), nullable=False)
@@ -329,6 +420,12 @@ class Order(db.Model):
 
 
 class OrderItem(db.Model):
+    __table_args__ = (
+        db.Index('ix_order_item_order', 'order_id'),
+        # 菜品销量统计、删除菜品时找受影响订单
+        db.Index('ix_order_item_dish_order', 'dish_id', 'order_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
     dish_id = db.Column(db.Integer, db.ForeignKey('dish.id'), nullable=False)
@@ -336,11 +433,560 @@ class OrderItem(db.Model):
     unit_price = db.Column(db.Numeric(10, 2), nullable=False)
 
 
+class RestaurantRevenue(db.Model):
+    """餐厅销售额汇总（由结账、删除菜品时在同一事务内维护），餐厅列表直接按它排序"""
+    __tablename__ = 'restaurant_revenue'
+    __table_args__ = (
+        db.Index('ix_restaurant_revenue_revenue', 'revenue', 'restaurant_id'),
+    )
+
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    last_order_at = db.Column(db.DateTime)
+
+
+class CartItem(db.Model):
+    """购物车条目（CART_BACKEND=sql 时使用）；dish_id 不设外键，菜品删除后条目在读取时被忽略"""
+    __tablename__ = 'cart_item'
+    __table_args__ = (
+        db.Index('ix_cart_item_user_restaurant', 'user_id', 'restaurant_id'),
+    )
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    dish_id = db.Column(db.Integer, primary_key=True)
+    restaurant_id = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    added_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class OrderItemHistory(db.Model):
+    """归档的订单项：下架菜品的冷订单项由 archive-orders 从 order_item 移到这里。
+    只移走下架菜品这一行，订单本身、总金额和其他菜品的订单项都保留，报表和顾客统计不受影响"""
+    __tablename__ = 'order_item_history'
+    __table_args__ = (
+        db.Index('ix_order_item_history_order', 'order_id'),
+        db.Index('ix_order_item_history_dish', 'dish_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # 原订单项 id
+    order_id = db.Column(db.Integer, nullable=False)
+    dish_id = db.Column(db.Integer, nullable=False)
+    dish_name = db.Column(db.String(120), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_price = db.Column(db.Numeric(10, 2), nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class MediaBlob(db.Model):
+    """按原图内容摘要去重的图片派生结果；ref_count 为引用它的数据行数，归零后由 gc-media 清理文件"""
+    __tablename__ = 'media_blob'
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'digest', name='uq_media_blob_kind_digest'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    digest = db.Column(db.String(64), nullable=False)
+    # 主图路径（头像 / logo / 菜品大图），释放引用时按它反查
+    path = db.Column(db.String(255), nullable=False, index=True)
+    # 派生出的全部字段，JSON：{字段名: 值}，直接回写到数据行
+    fields = db.Column(db.Text, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
 # ----------------- 登录管理 -----------------
 
+class UserPrincipal(UserMixin):
+    """登录用户的精简身份，作为 current_user 使用；只有用到餐厅时才查询 Restaurant"""
+
+    def __init__(self, id, username, avatar, restaurant_id):
+        self.id = id
+        self.username = username
+        self.avatar = avatar
+        self.restaurant_id = restaurant_id
+
+    @property
+    def restaurant(self):
+        # 没有餐厅也按缓存结果处理，不再每次按 owner_id 查询；
+        # 本进程创建餐厅时会清除缓存，其他进程最多延迟 USER_CACHE_TTL 秒看到新餐厅
+        if self.restaurant_id is None:
+            return None
+        return db.session.get(Restaurant, self.restaurant_id)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """Flask-Login 每个请求只调用一次；结果再按 USER_CACHE_TTL 在进程内缓存"""
+    ttl = app.config['USER_CACHE_TTL']
+    key = f'user:{int(user_id)}'
+    row = user_cache.get(key) if ttl else None
+    if row is None:
+        # 用户和餐厅 id 一条查询取出
+        row = db.session.query(User.id, User.username, User.avatar, Restaurant.id).outerjoin(
+            Restaurant, Restaurant.owner_id == User.id
+        ).filter(User.id == int(user_id)).first()
+        if row is None:
+            return None
+        row = tuple(row)
+        if ttl:
+            user_cache.set(key, row, ttl=ttl)
+    return UserPrincipal(*row)
+
+
+def invalidate_user_cache(user_id):
+    """头像、餐厅等登录信息变化后调用"""
+    user_cache.delete(f'user:{user_id}')
+
+
+# ----------------- 查询计数（调试） -----------------
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+def query_budget(max_queries):
+    """限制视图（含模板渲染）内执行的 SQL 条数，调试/测试模式下超出即报错，防止 N+1 回归"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            start = g.get('query_count', 0)
+            result = view(*args, **kwargs)
+            used = g.get('query_count', 0) - start
+            if (app.debug or app.testing) and used > max_queries:
+                raise AssertionError(
+                    f'{request.endpoint} 执行了 {used} 条查询，超出预算 {max_queries} 条'
+                )
+            return result
+        return wrapper
+    return decorator
+
+
+# ----------------- 缓存 -----------------
+
+class LRUCache:
+    """进程内带 TTL 的 LRU 缓存（线程安全）"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+class RedisCache:
+    """多进程共享的缓存后端，只依赖 get / setex / delete 三个 Redis 命令，
+    可以传入 redis-py 客户端，也可以传入实现了同名方法的本地替身"""
+
+    def __init__(self, client, prefix='restaurant-platform:'):
+        self.client = client
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.client.setex(self.prefix + key, int(ttl), value)
+        else:
+            self.client.set(self.prefix + key, value)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def make_cache(backend, max_entries=1024):
+    """按配置创建缓存后端；redis 不可用时退回进程内缓存"""
+    if backend == 'redis':
+        try:
+            import redis
+            return RedisCache(redis.Redis.from_url(app.config['REDIS_URL']))
+        except ImportError:
+            print("STATS_CACHE_BACKEND=redis 但未安装 redis 包，改用进程内缓存")
+    return LRUCache(max_entries=max_entries)
+
+
+stats_cache = make_cache(
+    app.config['STATS_CACHE_BACKEND'],
+    max_entries=app.config['STATS_CACHE_MAX_ENTRIES']
+)
+
+answer_cache = LRUCache(max_entries=app.config['ANSWER_CACHE_MAX_ENTRIES'])
+format_cache = LRUCache(max_entries=app.config['FORMAT_CACHE_MAX_ENTRIES'])
+blacklist_cache = LRUCache(max_entries=app.config['BLACKLIST_CACHE_MAX_ENTRIES'])
+user_cache = LRUCache(max_entries=app.config['USER_CACHE_MAX_ENTRIES'])
+
+
+def format_cache_key(text: str) -> str:
+    return 'html:' + hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def render_ai_answer(text) -> str:
+    """带缓存的 format_ai_answer：同样的回答文本只解析一次"""
+    if not text:
+        return ''
+    text = str(text)
+    key = format_cache_key(text)
+    html = format_cache.get(key)
+    if html is None:
+        html = format_ai_answer(text)
+        format_cache.set(key, html)
+    return html
+
+
+# ----------------- 购物车存储 -----------------
+# 购物车按用户 id 存在服务端，cookie 里只有 Flask-Login 的用户标识。
+# 各后端接口一致：items / incr / incr_many / set / clear，
+# incr 是原子操作，数量不会小于 0；incr_many 一次增加多道菜，要么全部生效要么都不生效。
+# 数据库后端不自行提交，调用方写完后执行 db.session.commit()。
+
+class SQLCartStore:
+    """数据库后端：数量增减用一条 UPDATE 完成，多个标签页同时操作不会丢失更新。
+    写操作不提交，由调用方提交（结账时和订单在同一事务里清空购物车）"""
+
+    def items(self, user_id, restaurant_id):
+        """返回 {菜品 id: 数量}，按加入顺序"""
+        rows = db.session.query(CartItem.dish_id, CartItem.quantity).filter_by(
+            user_id=user_id, restaurant_id=restaurant_id
+        ).order_by(CartItem.added_at, CartItem.dish_id)
+        return {dish_id: qty for dish_id, qty in rows}
+
+    def _upsert(self, user_id, restaurant_id, changes):
+        """changes: [(菜品 id, 已有条目的新数量表达式, 新条目的数量)]。
+        SQLite / PostgreSQL / MySQL 用一条 INSERT ... ON CONFLICT（ON DUPLICATE KEY）UPDATE 原子完成；
+        其他数据库先 UPDATE 再 INSERT，并发插入冲突时回滚保存点重试一次"""
+        dialect = db.engine.dialect.name
+        for dish_id, new_qty, initial in changes:
+            values = {'user_id': user_id, 'restaurant_id': restaurant_id, 'dish_id': dish_id,
+                      'quantity': initial, 'added_at': datetime.utcnow()}
+            if dialect in ('sqlite', 'postgresql'):
+                insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+                stmt = insert(CartItem).values(**values).on_conflict_do_update(
+                    index_elements=[CartItem.user_id, CartItem.dish_id],
+                    set_={'quantity': new_qty}
+                )
+            elif dialect in ('mysql', 'mariadb'):
+                stmt = mysql_insert(CartItem).values(**values).on_duplicate_key_update(quantity=new_qty)
+            else:
+                self._update_or_insert(user_id, restaurant_id, dish_id, new_qty, initial)
+                continue
+            db.session.execute(stmt)
+
+    def _update_or_insert(self, user_id, restaurant_id, dish_id, new_qty, initial):
+        for attempt in range(2):
+            try:
+                with db.session.begin_nested():
+                    updated = CartItem.query.filter_by(user_id=user_id, dish_id=dish_id).update(
+                        {CartItem.quantity: new_qty}, synchronize_session=False
+                    )
+                    if not updated:
+                        db.session.add(CartItem(user_id=user_id, restaurant_id=restaurant_id,
+                                                dish_id=dish_id, quantity=initial))
+                return
+            except IntegrityError:
+                if attempt:
+                    raise
+
+    def incr(self, user_id, restaurant_id, dish_id, delta):
+        """数量加 delta（可为负），返回新数量"""
+        new_qty = CartItem.quantity + delta
+        self._upsert(user_id, restaurant_id, [
+            (dish_id, case((new_qty < 0, 0), else_=new_qty), max(delta, 0))
+        ])
+        return self._quantity(user_id, dish_id)
+
+    def incr_many(self, user_id, restaurant_id, deltas):
+        """deltas: {菜品 id: 增加份数}（均为正数），随调用方的事务一起提交"""
+        self._upsert(user_id, restaurant_id, [
+            (dish_id, CartItem.quantity + delta, delta) for dish_id, delta in deltas.items()
+        ])
+
+    def set(self, user_id, restaurant_id, dish_id, quantity):
+        quantity = max(quantity, 0)
+        self._upsert(user_id, restaurant_id, [(dish_id, quantity, quantity)])
+        return quantity
+
+    def clear(self, user_id, restaurant_id):
+        CartItem.query.filter_by(user_id=user_id, restaurant_id=restaurant_id).delete(
+            synchronize_session=False
+        )
+
+    def _quantity(self, user_id, dish_id):
+        return db.session.query(CartItem.quantity).filter_by(
+            user_id=user_id, dish_id=dish_id
+        ).scalar() or 0
+
+
+class MemoryCartStore:
+    """进程内后端，只适合单进程调试"""
+
+    def __init__(self):
+        self._carts = {}
+        self._lock = threading.Lock()
+
+    def items(self, user_id, restaurant_id):
+        with self._lock:
+            return dict(self._carts.get((user_id, restaurant_id), {}))
+
+    def incr(self, user_id, restaurant_id, dish_id, delta):
+        with self._lock:
+            items = self._carts.setdefault((user_id, restaurant_id), {})
+            items[dish_id] = max(items.get(dish_id, 0) + delta, 0)
+            return items[dish_id]
+
+    def incr_many(self, user_id, restaurant_id, deltas):
+        with self._lock:
+            items = self._carts.setdefault((user_id, restaurant_id), {})
+            for dish_id, delta in deltas.items():
+                items[dish_id] = items.get(dish_id, 0) + delta
+
+    def set(self, user_id, restaurant_id, dish_id, quantity):
+        with self._lock:
+            items = self._carts.setdefault((user_id, restaurant_id), {})
+            items[dish_id] = max(quantity, 0)
+            return items[dish_id]
+
+    def clear(self, user_id, restaurant_id):
+        with self._lock:
+            self._carts.pop((user_id, restaurant_id), None)
+
+
+class RedisCartStore:
+    """Redis 后端：每个用户在每家餐厅一个 hash（菜品 id -> 数量），用 HINCRBY 原子增减。
+    只依赖 hgetall / hincrby / hset / delete / pipeline，可以传入实现了同名方法的本地替身"""
+
+    def __init__(self, client, prefix='restaurant-platform:cart:'):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, user_id, restaurant_id):
+        return f'{self.prefix}{user_id}:{restaurant_id}'
+
+    def items(self, user_id, restaurant_id):
+        raw = self.client.hgetall(self._key(user_id, restaurant_id))
+        # hash 不保证顺序，按菜品 id 排列
+        return {int(did): int(qty) for did, qty in sorted(raw.items(), key=lambda kv: int(kv[0]))}
+
+    def incr(self, user_id, restaurant_id, dish_id, delta):
+        key = self._key(user_id, restaurant_id)
+        qty = self.client.hincrby(key, dish_id, delta)
+        if qty < 0:
+            # 减到负数时把多减的加回来，并发下仍然收敛到 0
+            qty = self.client.hincrby(key, dish_id, -qty)
+        return max(qty, 0)
+
+    def incr_many(self, user_id, restaurant_id, deltas):
+        key = self._key(user_id, restaurant_id)
+        # MULTI/EXEC 事务：所有 HINCRBY 一起执行
+        pipe = self.client.pipeline(transaction=True)
+        for dish_id, delta in deltas.items():
+            pipe.hincrby(key, dish_id, delta)
+        pipe.execute()
+
+    def set(self, user_id, restaurant_id, dish_id, quantity):
+        quantity = max(quantity, 0)
+        self.client.hset(self._key(user_id, restaurant_id), dish_id, quantity)
+        return quantity
+
+    def clear(self, user_id, restaurant_id):
+        self.client.delete(self._key(user_id, restaurant_id))
+
+
+def make_cart_store(backend):
+    """按配置创建购物车后端；redis 不可用时退回数据库"""
+    if backend == 'redis':
+        try:
+            import redis
+            return RedisCartStore(redis.Redis.from_url(app.config['REDIS_URL']))
+        except ImportError:
+            print("CART_BACKEND=redis 但未安装 redis 包，改用数据库")
+    if backend == 'memory':
+        return MemoryCartStore()
+    return SQLCartStore()
+
+
+cart_store = make_cart_store(app.config['CART_BACKEND'])
+
+
+# ----------------- GPT 客户端 -----------------
+
+class GPTClient:
+    """共享的 chat/completions 客户端：连接池 + keep-alive，
+    连接/读取分开超时，429/5xx 和连接失败时带抖动退避重试"""
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url, api_key, model, pool_size=10,
+                 connect_timeout=5.0, read_timeout=30.0, max_retries=2, backoff=0.5, max_backoff=10.0):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+
+    def _sleep_before_retry(self, attempt, resp=None):
+        retry_after = (resp.headers.get('Retry-After') or '').strip() if resp is not None else ''
+        # 只认秒数形式的 Retry-After；HTTP 日期等其他格式按普通退避处理
+        if retry_after.isascii() and retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            # full jitter：在 [0, backoff * 2^attempt] 内随机等待，避免多个 worker 同时重试
+            delay = random.uniform(0, self.backoff * (2 ** attempt))
+        # 上游给出的等待时间不可信，最多等 max_backoff 秒，不让请求线程被长时间挂住
+        time.sleep(min(delay, self.max_backoff))
+
+    def post_chat(self, payload, stream=False):
+        """发送请求并返回 Response，重试耗尽或遇到不可重试的错误时抛出异常"""
+        url = self.base_url.rstrip('/') + '/chat/completions'
+        headers = {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json'
+        }
+        start = time.monotonic()
+        retries = 0
+        try:
+            while True:
+                try:
+                    resp = self.session.post(url, headers=headers, json=payload,
+                                             timeout=self.timeout, stream=stream)
+                except (requests.ConnectionError, requests.Timeout):
+                    if retries >= self.max_retries:
+                        raise
+                    self._sleep_before_retry(retries)
+                    retries += 1
+                    continue
+                if resp.status_code in self.RETRY_STATUS and retries < self.max_retries:
+                    resp.close()
+                    self._sleep_before_retry(retries, resp)
+                    retries += 1
+                    continue
+                resp.raise_for_status()
+                return resp
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            latency = time.monotonic() - start
+            with self._lock:
+                self.calls += 1
+                self.retries += retries
+                self.total_latency += latency
+                self.last_latency = latency
+
+    def complete(self, system_prompt, user_content):
+        payload = {
+            'model': self.model,
+            'messages': [
+                {'role': 'system', 'content': system_prompt},
+                {'role': 'user', 'content': user_content}
+            ]
+        }
+        data = self.post_chat(payload).json()
+        return data['choices'][0]['message']['content']
+
+    def stream_complete(self, system_prompt, user_content):
+        """以 stream: true 请求，逐个产出增量文本片段"""
+        payload = {
+            'model': self.model,
+            'stream': True,
+            'messages': [
+                {'role': 'system', 'content': system_prompt},
+                {'role': 'user', 'content': user_content}
+            ]
+        }
+        with self.post_chat(payload, stream=True) as resp:
+            for raw_line in resp.iter_lines():
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                choices = json.loads(data).get('choices') or [{}]
+                delta = (choices[0].get('delta') or {}).get('content')
+                if delta:
+                    yield delta
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'retries': self.retries,
+                'failures': self.failures,
+                'avg_latency_ms': round(self.total_latency / self.calls * 1000, 1) if self.calls else 0,
+                'last_latency_ms': round(self.last_latency * 1000, 1),
+            }
+
+
+gpt_client = GPTClient(
+    GPT_BASE_URL, GPT_API_KEY, GPT_MODEL,
+    pool_size=GPT_POOL_SIZE,
+    connect_timeout=GPT_CONNECT_TIMEOUT,
+    read_timeout=GPT_READ_TIMEOUT,
+    max_retries=GPT_MAX_RETRIES,
+    backoff=GPT_RETRY_BACKOFF,
+    max_backoff=GPT_MAX_BACKOFF
+)
 
 
 # ----------------- 工具函数 -----------------
@@ -354,22 +1000,44 @@ def ensure_upload_dirs():
         os.makedirs(path, exist_ok=True)
 
 
-def save_avatar(file_storage):
-    """保存用户头像，强制缩放到 100x100 以内"""
-    if not file_storage:
-        return None
+def stage_upload(file_storage, label):
+    """校验上传图片并把原始字节写入暂存目录，返回暂存文件路径（不解码像素）"""
     filename = secure_filename(file_storage.filename)
     ext = os.path.splitext(filename)[1].lower()
     if ext not in ALLOWED_IMAGE_EXT:
-        raise ValueError('头像格式不支持，只能上传 jpg/jpeg/png/gif')
+        raise ValueError(f'{label}格式不支持，只能上传 jpg/jpeg/png/gif')
+
+    # Image.open 只读取文件头，足以确认是不是图片
+    try:
+        Image.open(file_storage.stream)
+    except Exception:
+        raise ValueError(f'{label}无法识别，请上传有效的图片文件')
+    file_storage.stream.seek(0)
+
+    staging_dir = app.config['UPLOAD_STAGING_FOLDER']
+    os.makedirs(staging_dir, exist_ok=True)
+    staged_path = os.path.join(staging_dir, f"{uuid.uuid4().hex}{ext}")
+    file_storage.save(staged_path)
+    return staged_path
+
+
+def draft_size(size, box):
+    """按 thumbnail 缩放到 box 的比例，算出 JPEG draft 解码需要的最小尺寸（留 2 倍余量保证缩放质量）"""
+    ratio = min(box / size[0], box / size[1], 1)
+    return max(1, int(size[0] * ratio * 2)), max(1, int(size[1] * ratio * 2))
 
+
+def save_avatar(src_path, base_name=None):
+    """保存用户头像，强制缩放到 100x100 以内"""
     ensure_upload_dirs()
     avatar_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'avatars')
 
-    new_name = f"{uuid.uuid4().hex}{ext}"
+    ext = os.path.splitext(src_path)[1].lower()
+    new_name = f"{base_name or uuid.uuid4().hex}{ext}"
     save_path = os.path.join(avatar_dir, new_name)
 
-    img = Image.open(file_storage)
+    img = Image.open(src_path)
+    img.draft('RGB', draft_size(img.size, 100))
     img = img.convert('RGB')
     img.thumbnail((100, 100))
     img.save(save_path)
@@ -379,22 +1047,18 @@ def save_avatar(file_storage):
     return rel_path.replace('\\', '/')
 
 
-def save_logo(file_storage):
+def save_logo(src_path, base_name=None):
     """保存餐厅 logo（稍微大一点即可）"""
-    if not file_storage:
-        return None
-    filename = secure_filename(file_storage.filename)
-    ext = os.path.splitext(filename)[1].lower()
-    if ext not in ALLOWED_IMAGE_EXT:
-        raise ValueError('Logo 格式不支持，只能上传 jpg/jpeg/png/gif')
-
     ensure_upload_dirs()
     logo_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'logos')
 
-    new_name = f"{uuid.uuid4().hex}{ext}"
+    ext = os.path.splitext(src_path)[1].lower()
+    new_name = f"{base_name or uuid.uuid4().hex}{ext}"
     save_path = os.path.join(logo_dir, new_name)
 
-    img = Image.open(file_storage)
+    img = Image.open(src_path)
+    # 裁剪后要缩放到 300x300，短边解码到 600 以上即可
+    img.draft('RGB', (600, 600))
     img = img.convert('RGB')
     
     # 将图片裁剪为正方形（以较短边为准）
@@ -414,85 +1078,394 @@ def save_logo(file_storage):
     return rel_path.replace('\\', '/')
 
 
-def save_dish_images(file_storage):
-    """保存菜品图片，返回 (大图路径, 缩略图路径)"""
-    if not file_storage:
-        return None, None
-    filename = secure_filename(file_storage.filename)
-    ext = os.path.splitext(filename)[1].lower()
-    if ext not in ALLOWED_IMAGE_EXT:
-        raise ValueError('菜品图片格式不支持，只能上传 jpg/jpeg/png/gif')
+def save_image_variants(img, dish_dir, base_name):
+    """从已缩到 800px 以内的图片按配置宽度逐级缩小，生成 WebP（可选 AVIF）变体，返回清单"""
+    formats = [('webp', 'WEBP', {'quality': app.config['DISH_IMAGE_WEBP_QUALITY'], 'method': 4})]
+    if app.config['DISH_IMAGE_AVIF'] and features.check('avif'):
+        formats.append(('avif', 'AVIF', {'quality': app.config['DISH_IMAGE_AVIF_QUALITY']}))
+
+    variants = {fmt: [] for fmt, _, _ in formats}
+    saved_widths = set()
+    current = img
+    for width in sorted(set(app.config['DISH_IMAGE_WIDTHS']), reverse=True):
+        if width < current.width:
+            height = max(1, round(current.height * width / current.width))
+            current = current.resize((width, height), Image.Resampling.LANCZOS)
+        # 不放大：比原图还宽的尺寸都按原图宽度只生成一次
+        if current.width in saved_widths:
+            continue
+        saved_widths.add(current.width)
+        for fmt, pil_format, options in formats:
+            name = f"{base_name}_{current.width}.{fmt}"
+            current.save(os.path.join(dish_dir, name), pil_format, **options)
+            variants[fmt].append([current.width, f'uploads/dishes/{name}'])
+
+    for items in variants.values():
+        items.sort()
+    return variants
+
 
+def save_dish_images(src_path, base_name=None):
+    """保存菜品图片，返回 (大图路径, 缩略图路径, 响应式变体清单)"""
     ensure_upload_dirs()
     dish_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'dishes')
 
-    base_name = uuid.uuid4().hex
+    ext = os.path.splitext(src_path)[1].lower()
+    base_name = base_name or uuid.uuid4().hex
 
     # 大图
     big_name = f"{base_name}_big{ext}"
     big_path = os.path.join(dish_dir, big_name)
 
-    # 缩略图
-    thumb_name = f"{base_name}_thumb{ext}"
-    thumb_path = os.path.join(dish_dir, thumb_name)
-
-    img = Image.open(file_storage)
+    img = Image.open(src_path)
+    # JPEG 用 draft 模式直接按 1/2、1/4、1/8 缩小解码，不解出整张全分辨率图；其他格式无影响
+    img.draft('RGB', draft_size(img.size, 800))
     img = img.convert('RGB')
 
-    big_img = img.copy()
-    big_img.thumbnail((800, 800))
-    big_img.save(big_path)
-
-    thumb_img = img.copy()
-    thumb_img.thumbnail((100, 100))
-    thumb_img.save(thumb_path)
+    img.thumbnail((800, 800))
+    img.save(big_path)
+    rel_thumb, variants = save_dish_derivatives(img, dish_dir, base_name, ext)
 
     rel_big = os.path.join('uploads', 'dishes', big_name).replace('\\', '/')
+    return rel_big, rel_thumb, variants
+
+
+def save_dish_derivatives(img, dish_dir, base_name, ext):
+    """从 800px 以内的大图生成响应式变体和缩略图，返回 (缩略图路径, 变体清单)；会修改 img"""
+    variants = save_image_variants(img, dish_dir, base_name)
+
+    # 缩略图从已经缩到 800px 的图片派生，不再复制原图
+    thumb_name = f"{base_name}_thumb{ext}"
+    img.thumbnail((100, 100))
+    img.save(os.path.join(dish_dir, thumb_name))
+
     rel_thumb = os.path.join('uploads', 'dishes', thumb_name).replace('\\', '/')
-    return rel_big, rel_thumb
+    return rel_thumb, variants
 
 
-def get_cart():
-    """返回 session 中的购物车结构"""
-    return session.get('cart', {})
+# 图片类型 -> (模型, 状态字段, 主图字段, 任务字段)
+IMAGE_TARGETS = {
+    'avatar': (User, 'avatar_status', 'avatar', 'avatar_job'),
+    'logo': (Restaurant, 'logo_status', 'logo', 'logo_job'),
+    'dish': (Dish, 'image_status', 'image', 'image_job'),
+}
 
+_image_pool = None
 
-def save_cart(cart):
-    session['cart'] = cart
-    session.modified = True
 
+def get_image_pool():
+    global _image_pool
+    if _image_pool is None:
+        _image_pool = ProcessPoolExecutor(max_workers=app.config['IMAGE_WORKERS'])
+    return _image_pool
+
+
+def static_file_path(rel_path):
+    """数据库里保存的相对 static 路径 -> 磁盘路径"""
+    return os.path.join(os.path.dirname(app.config['UPLOAD_FOLDER']), rel_path)
+
+
+def file_digest(path):
+    """原图字节的 BLAKE2b 摘要（160 位十六进制），同一张图重复上传得到同一个摘要"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, 1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def process_staged_image(kind, staged_path, base_name=None):
+    """在进程池中执行：从暂存原图生成各尺寸图片，返回 {字段名: 相对 static 路径}"""
+    if kind == 'avatar':
+        return {'avatar': save_avatar(staged_path, base_name)}
+    if kind == 'logo':
+        return {'logo': save_logo(staged_path, base_name)}
+    big_path, thumb_path, variants = save_dish_images(staged_path, base_name)
+    return {'image': big_path, 'thumb': thumb_path, 'image_variants': json.dumps(variants)}
+
+
+def release_media(kind, path):
+    """数据行不再使用某张图片时减少其引用计数（旧数据没有登记的图片直接忽略）"""
+    if not path:
+        return
+    MediaBlob.query.filter_by(kind=kind, path=path).update(
+        {MediaBlob.ref_count: MediaBlob.ref_count - 1}, synchronize_session=False
+    )
+
+
+def attach_media(row, kind, blob):
+    """把已派生好的图片挂到数据行上：释放旧图引用，回写字段并增加新图引用，结束处理中的任务（不提交）"""
+    _, status_field, path_field, job_field = IMAGE_TARGETS[kind]
+    setattr(row, status_field, 'ready')
+    setattr(row, job_field, None)
+    old_path = getattr(row, path_field)
+    if old_path == blob.path:
+        return
+    release_media(kind, old_path)
+    for name, value in json.loads(blob.fields).items():
+        setattr(row, name, value)
+    MediaBlob.query.filter_by(id=blob.id).update(
+        {MediaBlob.ref_count: MediaBlob.ref_count + 1}, synchronize_session=False
+    )
+
+
+def media_files(fields):
+    """列出一组图片字段对应的全部文件（相对 static 路径）"""
+    files = []
+    for name, value in fields.items():
+        if name == 'image_variants':
+            for items in json.loads(value).values():
+                files.extend(path for _, path in items)
+        elif value:
+            files.append(value)
+    return files
+
+
+def register_media_blob(kind, digest, fields, path_field):
+    """登记去重记录并返回（不提交）。同一张图并发上传时另一个任务可能抢先登记（唯一约束冲突），
+    此时回滚后直接使用已有记录：文件名由摘要决定，内容相同。需在修改其他数据之前调用"""
+    blob = MediaBlob.query.filter_by(kind=kind, digest=digest).first()
+    if blob:
+        return blob
+    db.session.add(MediaBlob(kind=kind, digest=digest, path=fields[path_field],
+                             fields=json.dumps(fields), ref_count=0))
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+    return MediaBlob.query.filter_by(kind=kind, digest=digest).one()
+
+
+def finish_image_processing(kind, row_id, staged_path, digest, future):
+    """图片处理完成后登记去重记录，回写对应数据行的路径和状态，并删除暂存原图。
+
+    数据行的任务字段已指向更新的上传（或已被清空）时，说明这次结果已经过时，只登记去重记录不回写。
+    """
+    model, status_field, path_field, job_field = IMAGE_TARGETS[kind]
+    job = os.path.basename(staged_path)
+    try:
+        fields = future.result()
+    except Exception as e:
+        print("Image processing error:", repr(e))
+        fields = None
+
+    with app.app_context():
+        if fields is None:
+            row = db.session.get(model, row_id)
+            if row and getattr(row, job_field) == job:
+                setattr(row, status_field, 'failed')
+                setattr(row, job_field, None)
+        else:
+            blob = register_media_blob(kind, digest, fields, path_field)
+            row = db.session.get(model, row_id)
+            # 数据行已被删除或结果已过时时只登记记录，引用为 0，等 gc-media 清理
+            if row and getattr(row, job_field) == job:
+                attach_media(row, kind, blob)
+        db.session.commit()
+    if kind == 'avatar':
+        invalidate_user_cache(row_id)
+
+    try:
+        os.remove(staged_path)
+    except OSError:
+        pass
+
+
+def enqueue_image_processing(kind, row_id, staged_path, sync=None):
+    """提交图片处理任务；数据行需已提交，且任务字段已设为暂存文件名，处理完成前页面显示占位图。
+
+    之后再上传的图片会覆盖任务字段，先提交的任务晚完成时不会盖掉新图。
+    同一张原图已经派生过时直接复用已有文件，不再解码和缩放。
+    sync 为 None 时按 IMAGE_PROCESSING_SYNC 配置决定是否在当前进程内处理。
+    """
+    model = IMAGE_TARGETS[kind][0]
+    digest = file_digest(staged_path)
+    blob = MediaBlob.query.filter_by(kind=kind, digest=digest).first()
+    if blob:
+        row = db.session.get(model, row_id)
+        if row:
+            attach_media(row, kind, blob)
+            db.session.commit()
+        if kind == 'avatar':
+            invalidate_user_cache(row_id)
+        try:
+            os.remove(staged_path)
+        except OSError:
+            pass
+        return
+
+    if app.config['IMAGE_PROCESSING_SYNC'] if sync is None else sync:
+        future = Future()
+        try:
+            future.set_result(process_staged_image(kind, staged_path, digest))
+        except Exception as e:
+            future.set_exception(e)
+        finish_image_processing(kind, row_id, staged_path, digest, future)
+        return
+
+    future = get_image_pool().submit(process_staged_image, kind, staged_path, digest)
+    future.add_done_callback(partial(finish_image_processing, kind, row_id, staged_path, digest))
+
+
+def sweep_image_jobs(older_than, dry_run=False):
+    """处理进程中途退出留下的图片任务，返回 (重新处理数, 标记失败数, 删除的暂存文件数)。
+
+    超过 older_than 仍是 pending 的数据行：暂存原图还在就在当前进程重新处理，否则标记为 failed；
+    不再被任何数据行引用的过期暂存文件直接删除。
+    """
+    staging_dir = app.config['UPLOAD_STAGING_FOLDER']
+    cutoff = time.time() - older_than.total_seconds()
+
+    def is_stale(path):
+        try:
+            return os.path.getmtime(path) < cutoff
+        except OSError:
+            return True
+
+    requeued = failed = 0
+    active_jobs = set()
+    for kind, (model, status_field, _, job_field) in IMAGE_TARGETS.items():
+        rows = db.session.query(model.id, getattr(model, job_field)).filter(
+            getattr(model, status_field) == 'pending'
+        ).all()
+        for row_id, job in rows:
+            staged_path = os.path.join(staging_dir, job) if job else None
+            if staged_path and not is_stale(staged_path):
+                active_jobs.add(job)
+                continue
+            if staged_path and os.path.exists(staged_path):
+                active_jobs.add(job)
+                requeued += 1
+                if not dry_run:
+                    enqueue_image_processing(kind, row_id, staged_path, sync=True)
+                continue
+            failed += 1
+            if not dry_run:
+                model.query.filter_by(id=row_id).filter(getattr(model, status_field) == 'pending').update(
+                    {status_field: 'failed', job_field: None}, synchronize_session=False
+                )
+                db.session.commit()
+
+    removed = 0
+    names = os.listdir(staging_dir) if os.path.isdir(staging_dir) else []
+    for name in names:
+        path = os.path.join(staging_dir, name)
+        if name in active_jobs or not os.path.isfile(path) or not is_stale(path):
+            continue
+        removed += 1
+        if not dry_run:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return requeued, failed, removed
+
+
+def gc_media_blobs(dry_run=False):
+    """删除引用计数归零的去重记录及其文件，返回 (记录数, 文件数)"""
+    blobs = MediaBlob.query.filter(MediaBlob.ref_count <= 0).all()
+    removed_blobs = removed_files = 0
+    for blob in blobs:
+        files = media_files(json.loads(blob.fields))
+        if dry_run:
+            removed_blobs += 1
+            removed_files += len(files)
+            continue
+        # 条件删除：扫描之后又被重新引用的记录保留
+        deleted = MediaBlob.query.filter(
+            MediaBlob.id == blob.id, MediaBlob.ref_count <= 0
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        if not deleted:
+            continue
+        removed_blobs += 1
+        for rel_path in files:
+            try:
+                os.remove(static_file_path(rel_path))
+                removed_files += 1
+            except OSError:
+                pass
+    return removed_blobs, removed_files
 
-def add_to_cart(dish_id, quantity=1):
-    dish = Dish.query.get_or_404(dish_id)
-    restaurant_id = str(dish.restaurant_id)
 
-    cart = get_cart()
-    if restaurant_id not in cart:
-        cart[restaurant_id] = {}
-    dish_key = str(dish_id)
-    cart[restaurant_id][dish_key] = cart[restaurant_id].get(dish_key, 0) + quantity
-    # 不再删除数量为0的菜品，保留在购物车中
-    save_cart(cart)
+CART_MAX_QUANTITY = 99
+
+
+def parse_cart_quantity(value, minimum=0):
+    """解析接口传来的数量：只接受整数或数字字符串，不在 minimum～CART_MAX_QUANTITY 之间返回 None"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        return None
+    return value if minimum <= value <= CART_MAX_QUANTITY else None
+
+
+def add_to_cart(dish, quantity=1):
+    return cart_store.incr(current_user.id, dish.restaurant_id, dish.id, quantity)
+
+
+def parse_positive_id(value):
+    """旧 session 购物车里的 id / 数量：正整数或数字字符串，否则返回 None"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if 0 < value < 2 ** 31 else None
+
+
+def migrate_session_cart():
+    """把旧版本存在 session['cart'] 里的购物车（{餐厅 id: {菜品 id: 数量}}）并入 cart_store，
+    并从 session 删除，之后 cookie 不再携带购物车。已下架或不存在的菜品直接丢弃"""
+    legacy = session.pop('cart', None)
+    if not isinstance(legacy, dict):
+        return
+    for rid, items in legacy.items():
+        if not isinstance(items, dict):
+            continue
+        restaurant_id = parse_positive_id(rid)
+        wanted = {}
+        for did, qty in items.items():
+            dish_id, qty = parse_positive_id(did), parse_positive_id(qty)
+            if dish_id and qty:
+                wanted[dish_id] = qty
+        if not restaurant_id or not wanted:
+            continue
+        active = {dish_id for dish_id, in db.session.query(Dish.id).filter(
+            Dish.id.in_(list(wanted)), Dish.restaurant_id == restaurant_id, Dish.archived_at.is_(None)
+        )}
+        current = cart_store.items(current_user.id, restaurant_id)
+        deltas = {}
+        for dish_id, qty in wanted.items():
+            qty = min(qty, CART_MAX_QUANTITY - current.get(dish_id, 0))
+            if dish_id in active and qty > 0:
+                deltas[dish_id] = qty
+        if deltas:
+            cart_store.incr_many(current_user.id, restaurant_id, deltas)
+    db.session.commit()
+
+
+@app.before_request
+def _migrate_session_cart():
+    if 'cart' in session and current_user.is_authenticated:
+        migrate_session_cart()
 
 
 def get_cart_items_for_restaurant(restaurant_id, include_zero=False):
     """返回某餐厅在购物车中的详细条目列表和总价
     include_zero: 如果为True，包含数量为0的菜品；如果为False，只返回数量>0的菜品（用于结账）
     """
-    rid = str(restaurant_id)
-    cart = get_cart()
-    items = cart.get(rid, {})
+    items = cart_store.items(current_user.id, restaurant_id)
     if not items:
         return [], Decimal('0.00')
 
-    dish_ids = [int(did) for did in items.keys()]
-    dishes = Dish.query.filter(Dish.id.in_(dish_ids)).all()
+    dishes = Dish.query.filter(Dish.id.in_(list(items)), Dish.archived_at.is_(None)).all()
     dish_map = {d.id: d for d in dishes}
 
     result = []
     total = Decimal('0.00')
-    for did_str, qty in items.items():
-        did = int(did_str)
+    for did, qty in items.items():
         dish = dish_map.get(did)
         if not dish:
             continue
@@ -512,37 +1485,213 @@ def get_cart_items_for_restaurant(restaurant_id, include_zero=False):
     return result, total
 
 
+def get_cart_total(restaurant_id):
+    """只查询价格列计算购物车总价（数量为 0 的菜品不计入）"""
+    items = cart_store.items(current_user.id, restaurant_id)
+    quantities = {did: qty for did, qty in items.items() if qty > 0}
+    if not quantities:
+        return Decimal('0.00')
+    prices = db.session.query(Dish.id, Dish.price).filter(
+        Dish.id.in_(list(quantities)), Dish.archived_at.is_(None)
+    )
+    return sum((Decimal(str(price)) * quantities[did] for did, price in prices), Decimal('0.00'))
+
+
+def get_blacklisted_ids(restaurant_id) -> frozenset:
+    """某餐厅黑名单中的用户 id 集合（一条查询；开启 BLACKLIST_CACHE_TTL 时走进程内缓存）"""
+    ttl = app.config['BLACKLIST_CACHE_TTL']
+    key = f'blacklist:{restaurant_id}'
+    if ttl:
+        ids = blacklist_cache.get(key)
+        if ids is not None:
+            return ids
+    ids = frozenset(uid for uid, in db.session.execute(
+        db.select(blacklist_table.c.user_id).where(blacklist_table.c.restaurant_id == restaurant_id)
+    ))
+    if ttl:
+        blacklist_cache.set(key, ids, ttl=ttl)
+    return ids
+
+
 def is_blacklisted(restaurant: Restaurant, user: User) -> bool:
-    if not restaurant or not user:
+    if not restaurant or not user or not getattr(user, 'is_authenticated', True):
         return False
-    return user in restaurant.blacklisted_users
+    if app.config['BLACKLIST_CACHE_TTL']:
+        return user.id in get_blacklisted_ids(restaurant.id)
+    # 按 (restaurant_id, user_id) 主键判断是否存在，不加载整个黑名单
+    return db.session.execute(db.select(db.exists().where(
+        blacklist_table.c.restaurant_id == restaurant.id,
+        blacklist_table.c.user_id == user.id,
+    ))).scalar()
+
+
+def invalidate_blacklist_cache(restaurant_id):
+    blacklist_cache.delete(f'blacklist:{restaurant_id}')
+
+
+def record_restaurant_order(order: Order):
+    """结账时把新订单累加到餐厅汇总（不提交，随订单一起提交）"""
+    updated = RestaurantRevenue.query.filter_by(restaurant_id=order.restaurant_id).update({
+        RestaurantRevenue.order_count: RestaurantRevenue.order_count + 1,
+        # 保留两位小数，避免浮点累加误差影响列表分页的游标比较
+        RestaurantRevenue.revenue: func.round(RestaurantRevenue.revenue + order.total_amount, 2),
+        RestaurantRevenue.last_order_at: order.created_at,
+    }, synchronize_session=False)
+    if not updated:
+        db.session.add(RestaurantRevenue(
+            restaurant_id=order.restaurant_id,
+            order_count=1,
+            revenue=order.total_amount,
+            last_order_at=order.created_at
+        ))
+
+
+def rebuild_restaurant_revenue():
+    """用一次分组查询重建所有餐厅的汇总，返回餐厅数量"""
+    rows = db.session.query(
+        Restaurant.id,
+        func.count(Order.id),
+        func.coalesce(func.sum(Order.total_amount), 0),
+        func.max(Order.created_at)
+    ).outerjoin(Order, Order.restaurant_id == Restaurant.id)\
+     .group_by(Restaurant.id).all()
+
+    RestaurantRevenue.query.delete()
+    for restaurant_id, order_count, revenue, last_order_at in rows:
+        db.session.add(RestaurantRevenue(
+            restaurant_id=restaurant_id,
+            order_count=order_count,
+            revenue=revenue,
+            last_order_at=last_order_at
+        ))
+    db.session.commit()
+    return len(rows)
 
 
-def call_gpt(system_prompt: str, user_content: str) -> str:
-    """调用 GPT 接口，返回回答文本"""
+def backfill_restaurant_revenue():
+    """给还没有汇总行的餐厅补上汇总（餐厅列表只显示有汇总行的餐厅），返回补上的数量"""
+    rows = db.session.query(
+        Restaurant.id,
+        func.count(Order.id),
+        func.coalesce(func.sum(Order.total_amount), 0),
+        func.max(Order.created_at)
+    ).outerjoin(RestaurantRevenue, RestaurantRevenue.restaurant_id == Restaurant.id)\
+     .outerjoin(Order, Order.restaurant_id == Restaurant.id)\
+     .filter(RestaurantRevenue.restaurant_id.is_(None))\
+     .group_by(Restaurant.id).all()
+
+    for restaurant_id, order_count, revenue, last_order_at in rows:
+        db.session.add(RestaurantRevenue(
+            restaurant_id=restaurant_id,
+            order_count=order_count,
+            revenue=revenue,
+            last_order_at=last_order_at
+        ))
+    db.session.commit()
+    return len(rows)
+
+
+def get_active_dish_or_404(dish_id):
+    """未下架的菜品，已下架或不存在时返回 404"""
+    return Dish.query.filter(Dish.id == dish_id, Dish.archived_at.is_(None)).first_or_404()
+
+
+def archive_cold_order_items(cutoff, batch_size=500, dry_run=False):
+    """把 cutoff 之前订单里属于下架菜品的订单项移入 order_item_history，再彻底删除已没有订单项引用的下架菜品。
+    订单和其他菜品的订单项不动；每批单独提交，避免长事务；返回 (归档订单项数, 删除菜品数)"""
+    cold_items = db.select(OrderItem.id)\
+        .join(Dish, Dish.id == OrderItem.dish_id)\
+        .join(Order, Order.id == OrderItem.order_id)\
+        .where(Dish.archived_at.isnot(None), Order.created_at < cutoff)
+    has_items = db.select(OrderItem.id).where(OrderItem.dish_id == Dish.id).exists()
+    if dry_run:
+        # 只统计已经没有订单项引用的下架菜品；归档后才变得可删除的菜品不计入
+        item_count = db.session.execute(db.select(func.count()).select_from(cold_items.subquery())).scalar()
+        purgeable = Dish.query.filter(Dish.archived_at.isnot(None), ~has_items).count()
+        return item_count, purgeable
+
+    moved = 0
+    restaurant_ids = set()
+    while True:
+        item_ids = [item_id for item_id, in db.session.execute(
+            cold_items.order_by(OrderItem.id).limit(batch_size)
+        )]
+        if not item_ids:
+            break
+        # INSERT ... SELECT 后删除同一批订单项，同一事务提交
+        db.session.execute(db.insert(OrderItemHistory).from_select(
+            ['id', 'order_id', 'dish_id', 'dish_name', 'quantity', 'unit_price', 'archived_at'],
+            db.select(OrderItem.id, OrderItem.order_id, OrderItem.dish_id, Dish.name,
+                      OrderItem.quantity, OrderItem.unit_price, db.literal(datetime.utcnow()))
+            .join(Dish, Dish.id == OrderItem.dish_id)
+            .where(OrderItem.id.in_(item_ids))
+        ))
+        restaurant_ids.update(rid for rid, in db.session.execute(
+            db.select(Dish.restaurant_id).join(OrderItem, OrderItem.dish_id == Dish.id)
+            .where(OrderItem.id.in_(item_ids)).distinct()
+        ))
+        db.session.execute(
+            db.delete(OrderItem).where(OrderItem.id.in_(item_ids))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        moved += len(item_ids)
+
+    purged = 0
+    for dish in Dish.query.filter(Dish.archived_at.isnot(None), ~has_items).all():
+        release_media('dish', dish.image)
+        db.session.delete(dish)
+        purged += 1
+    db.session.commit()
+
+    # 菜品销量统计不再包含归档的订单项，统计快照需要重建
+    for restaurant_id in restaurant_ids:
+        invalidate_stats_cache(restaurant_id)
+    return moved, purged
+
+
+def request_gpt(system_prompt: str, user_content: str) -> str:
+    """请求 GPT 接口并返回回答文本，失败时抛出异常"""
+    return gpt_client.complete(system_prompt, user_content)
+
+
+GPT_NO_KEY_MESSAGE = "当前系统未配置 GPT_API_KEY，无法使用智能问答功能。"
+GPT_UNAVAILABLE_MESSAGE = "智能问答服务暂时不可用，请稍后再试。"
+
+
+def normalize_question(question: str) -> str:
+    """问题归一化：合并空白、忽略大小写和结尾标点，让“辣不辣？”与“辣不辣”命中同一缓存"""
+    return ' '.join(question.split()).casefold().rstrip('?？!！。.～~ ')
+
+
+def answer_cache_key(system_prompt: str, context: str, question: str) -> str:
+    def digest(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return 'answer:' + digest('\0'.join([
+        GPT_MODEL, digest(system_prompt), digest(context), normalize_question(question)
+    ]))
+
+
+def call_gpt_cached(system_prompt: str, context: str, question: str) -> str:
+    """带答案缓存的 GPT 调用；context 是拼在问题前面的统计快照，失败的回答不缓存"""
     if not GPT_API_KEY:
-        return "当前系统未配置 GPT_API_KEY，无法使用智能问答功能。"
+        return GPT_NO_KEY_MESSAGE
+
+    key = answer_cache_key(system_prompt, context, question)
+    cached = answer_cache.get(key)
+    if cached is not None:
+        answer, html = cached
+        # 渲染好的 HTML 和答案存在一起，重新显示时模板过滤器直接命中，不用再解析 Markdown
+        format_cache.set(format_cache_key(answer), html)
+        return answer
 
     try:
-        url = GPT_BASE_URL.rstrip('/') + '/chat/completions'
-        headers = {
-            'Authorization': f'Bearer {GPT_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            'model': GPT_MODEL,
-            'messages': [
-                {'role': 'system', 'content': system_prompt},
-                {'role': 'user', 'content': user_content}
-            ]
-        }
-        resp = requests.post(url, headers=headers, json=payload, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
-        return data['choices'][0]['message']['content']
+        answer = request_gpt(system_prompt, context + question)
     except Exception as e:
         print("GPT error:", repr(e))
-        return "智能问答服务暂时不可用，请稍后再试。"
+        return GPT_UNAVAILABLE_MESSAGE
+    answer_cache.set(key, (answer, render_ai_answer(answer)), ttl=app.config['ANSWER_CACHE_TTL'])
+    return answer
 
 
 def build_restaurant_stats_text(restaurant: Restaurant) -> str:
@@ -616,21 +1765,332 @@ def build_restaurant_stats_text(restaurant: Restaurant) -> str:
 
 def build_menu_stats_text(restaurant: Restaurant) -> str:
     """构建菜品列表统计给 GPT（菜品顾问用）"""
-    dishes = Dish.query.filter_by(restaurant_id=restaurant.id).all()
-    if not dishes:
+    # 一次分组查询拿到所有菜品、所属分类和被点份数
+    rows = db.session.query(
+        Dish,
+        Category.name,
+        func.coalesce(func.sum(OrderItem.quantity), 0).label('qty')
+    ).join(Category, Dish.category_id == Category.id)\
+     .outerjoin(OrderItem, OrderItem.dish_id == Dish.id)\
+     .filter(Dish.restaurant_id == restaurant.id, Dish.archived_at.is_(None))\
+     .group_by(Dish.id, Category.name)\
+     .order_by(Dish.id).all()
+    if not rows:
         return "当前餐厅还没有任何菜品。"
 
     lines = [f"餐厅名称：{restaurant.name}", "菜品列表："]
-    for dish in dishes:
-        total_qty = db.session.query(func.coalesce(func.sum(OrderItem.quantity), 0))\
-            .filter(OrderItem.dish_id == dish.id).scalar() or 0
+    for dish, category_name, total_qty in rows:
         lines.append(
-            f"- 菜品ID: {dish.id}, 名称: {dish.name}, 分类: {dish.category.name}, "
+            f"- 菜品ID: {dish.id}, 名称: {dish.name}, 分类: {category_name}, "
             f"价格: {dish.price} 元, 被点份数: {total_qty} 份, 简介: {dish.description or '无'}"
         )
     return "\n".join(lines)
 
 
+def get_restaurant_stats_text(restaurant: Restaurant) -> str:
+    """带缓存的经营顾问统计快照"""
+    key = f'stats:restaurant:{restaurant.id}'
+    text = stats_cache.get(key)
+    if text is None:
+        text = build_restaurant_stats_text(restaurant)
+        stats_cache.set(key, text, ttl=app.config['STATS_CACHE_TTL'])
+    return text
+
+
+def get_menu_stats_text(restaurant: Restaurant) -> str:
+    """带缓存的菜品顾问菜单快照"""
+    key = f'stats:menu:{restaurant.id}'
+    text = stats_cache.get(key)
+    if text is None:
+        text = build_menu_stats_text(restaurant)
+        stats_cache.set(key, text, ttl=app.config['STATS_CACHE_TTL'])
+    return text
+
+
+def invalidate_stats_cache(restaurant_id):
+    """订单或菜品变化后清除该餐厅的统计快照"""
+    stats_cache.delete(f'stats:restaurant:{restaurant_id}')
+    stats_cache.delete(f'stats:menu:{restaurant_id}')
+
+
+# 头像和 logo 只保存了一份派生图，原图不保留，重新编码只会在有损文件上叠加损失，不参与重新生成
+REDERIVE_KINDS = ('dish',)
+
+
+def rederive_media(kind, path):
+    """在进程池中执行：原图不保留，用已保存的菜品大图重新生成缩略图和响应式变体，返回需要回写的字段。
+
+    大图保持不变；新文件换一个随机后缀写入，不覆盖正在被访问的旧文件，回写成功后再删除旧文件。
+    """
+    src_path = static_file_path(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    ensure_upload_dirs()
+    dish_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'dishes')
+    base_name = stem[:-len('_big')] if stem.endswith('_big') else stem
+    ext = os.path.splitext(path)[1].lower()
+    img = Image.open(src_path).convert('RGB')
+    img.thumbnail((800, 800))
+    thumb_path, variants = save_dish_derivatives(img, dish_dir, f'{base_name}_{uuid.uuid4().hex[:8]}', ext)
+    return {'image': path, 'thumb': thumb_path, 'image_variants': json.dumps(variants)}
+
+
+def list_media_paths(kind):
+    """某类图片当前被数据行引用的全部主图路径（多行共用的图片只出现一次）"""
+    model, _, path_field, _ = IMAGE_TARGETS[kind]
+    column = getattr(model, path_field)
+    rows = db.session.query(column).filter(column.isnot(None), column != '').distinct().order_by(column)
+    return [path for path, in rows]
+
+
+def apply_rederived_media(kind, path, fields):
+    """把重新生成的字段回写到所有使用该图片的数据行和去重记录，并删除不再使用的旧缩略图和变体文件"""
+    model, _, path_field, _ = IMAGE_TARGETS[kind]
+    column = getattr(model, path_field)
+
+    new_files = set(media_files(fields))
+    stale_files = set()
+    for thumb, variants_json in db.session.query(Dish.thumb, Dish.image_variants).filter(column == path).distinct():
+        stale_files.update(media_files({'thumb': thumb, 'image_variants': variants_json or '{}'}))
+    stale_files -= new_files
+
+    model.query.filter(column == path).update(fields, synchronize_session=False)
+    MediaBlob.query.filter_by(kind=kind, path=path).update(
+        {MediaBlob.fields: json.dumps(fields)}, synchronize_session=False
+    )
+    db.session.commit()
+
+    for rel_path in stale_files:
+        try:
+            os.remove(static_file_path(rel_path))
+        except OSError:
+            pass
+
+
+# ----------------- 智能问答 -----------------
+
+ADVISOR_SYSTEM_PROMPT = (
+    "你是一位经验丰富的餐厅经营顾问，擅长数据分析、市场洞察和经营策略制定。"
+    "你的回答应该：\n"
+    "1. 基于提供的真实统计数据进行分析，给出具体的数据支撑\n"
+    "2. 用简体中文、条理清晰地回答，使用分段和要点来组织内容\n"
+    "3. 如果问题涉及具体顾客或菜品，要引用数据中的具体信息（如姓名、金额、数量等）\n"
+    "4. 提供实用的建议和洞察，帮助老板做出更好的经营决策\n"
+    "5. 使用**粗体**来突出重要信息，使用*斜体*来强调次要信息\n"
+    "6. 回答要专业但友好，避免过于技术化的术语\n"
+    "7. 如果数据不足，要诚实说明，并给出基于经验的建议"
+)
+
+
+DISH_ADVISOR_SYSTEM_PROMPT = (
+    "你是一位专业的餐厅点餐顾问，擅长帮助顾客选择适合的菜品。"
+    "你的回答应该：\n"
+    "1. 优先围绕顾客当前浏览的菜品回答，但如果顾客明确提到其他菜品，要综合考虑整个菜单\n"
+    "2. 使用简体中文，语气友好、亲切，像朋友一样给出建议\n"
+    "3. 结合菜品数据（价格、被点次数、评价等）来回答，让建议更有说服力\n"
+    "4. 如果顾客询问菜品特点、搭配建议、口味等，要基于菜单信息给出具体建议\n"
+    "5. 使用**粗体**来突出重要信息，使用*斜体*来强调次要信息\n"
+    "6. 回答要简洁明了，避免冗长，但要有足够的信息帮助顾客做决定\n"
+    "7. 如果数据不足，可以基于菜品名称和分类给出合理的建议"
+)
+
+
+def build_advisor_context(restaurant: Restaurant) -> str:
+    """经营顾问：拼在老板问题前面的统计快照"""
+    stats_text = get_restaurant_stats_text(restaurant)
+    return f"餐厅数据如下：\n{stats_text}\n\n老板的问题是："
+
+
+def build_dish_advisor_context(restaurant: Restaurant, dish: Dish) -> str:
+    """菜品顾问：拼在顾客问题前面的菜单快照"""
+    menu_text = get_menu_stats_text(restaurant)
+    return (
+        f"完整菜单和销售数据如下：\n{menu_text}\n\n"
+        f"顾客当前正在查看的菜品是：{dish.name}（ID: {dish.id}）。\n"
+        f"顾客的问题是："
+    )
+
+
+def sse_event(name, data) -> str:
+    return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def iter_answer_events(system_prompt: str, context: str, question: str):
+    """流式生成回答，逐步产出 (事件名, 内容)：delta 为新增的原始文本片段，只发送新增部分；
+    结束时产出一次 answer（格式化好的完整 HTML）或 error；答案完整后写入答案缓存"""
+    if not GPT_API_KEY:
+        yield 'answer', format_ai_answer(GPT_NO_KEY_MESSAGE)
+        return
+
+    key = answer_cache_key(system_prompt, context, question)
+    cached = answer_cache.get(key)
+    if cached is not None:
+        yield 'answer', cached[1]
+        return
+
+    parts = []
+    try:
+        for delta in gpt_client.stream_complete(system_prompt, context + question):
+            if delta:
+                parts.append(delta)
+                yield 'delta', delta
+    except Exception as e:
+        print("GPT stream error:", repr(e))
+        yield 'error', format_ai_answer(GPT_UNAVAILABLE_MESSAGE)
+        return
+
+    answer = ''.join(parts)
+    html = render_ai_answer(answer)
+    yield 'answer', html
+    answer_cache.set(key, (answer, html), ttl=app.config['ANSWER_CACHE_TTL'])
+
+
+def stream_gpt_answer(system_prompt: str, context: str, question: str):
+    """以 SSE 事件流式输出回答：delta 事件只带新增文本，answer / error 事件带最终 HTML，最后发送 done"""
+    for name, value in iter_answer_events(system_prompt, context, question):
+        yield sse_event(name, {'text': value} if name == 'delta' else {'html': value})
+        if name == 'error':
+            return
+    yield sse_event('done', {})
+
+
+def sse_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+class QueueFull(Exception):
+    pass
+
+
+class AdvisorJobQueue:
+    """智能问答后台任务队列：GPT 请求交给有界线程池执行，请求线程立即返回任务 ID，
+    页面轮询任务状态。同时限制全局排队数和单个餐厅的并发数，并统计排队深度和等待时间。
+    任务保存在进程内，多进程部署时轮询请求需要落到同一进程（粘性会话）"""
+
+    def __init__(self, max_workers=4, max_queue=32, per_restaurant=2, result_ttl=600):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='advisor')
+        self.max_queue = max_queue
+        self.per_restaurant = per_restaurant
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active = {}  # restaurant_id -> 排队中和执行中的任务数
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, restaurant_id, user_id, system_prompt, context, question):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull('智能顾问当前太忙，请稍后再试。')
+            if self._active.get(restaurant_id, 0) >= self.per_restaurant:
+                self.rejected += 1
+                raise QueueFull('本餐厅正在处理的问题较多，请稍后再试。')
+            job = {
+                'id': uuid.uuid4().hex,
+                'restaurant_id': restaurant_id,
+                'user_id': user_id,
+                'status': 'queued',
+                'text': '',  # 生成中的原始文本，轮询时按 offset 只返回新增部分
+                'html': '',  # 结束后格式化好的完整 HTML
+                'submitted_at': now,
+                'finished_at': None,
+            }
+            self._jobs[job['id']] = job
+            self._active[restaurant_id] = self._active.get(restaurant_id, 0) + 1
+            self.queued += 1
+        self.executor.submit(self._run, job, system_prompt, context, question)
+        return job['id']
+
+    def _run(self, job, system_prompt, context, question):
+        started = time.monotonic()
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            wait = started - job['submitted_at']
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            job['status'] = 'running'
+
+        status = 'done'
+        try:
+            for name, value in iter_answer_events(system_prompt, context, question):
+                if name == 'delta':
+                    job['text'] += value
+                else:
+                    job['html'] = value
+                if name == 'error':
+                    status = 'failed'
+        except Exception as e:
+            print("Advisor job error:", repr(e))
+            job['html'] = format_ai_answer(GPT_UNAVAILABLE_MESSAGE)
+            status = 'failed'
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                restaurant_id = job['restaurant_id']
+                self._active[restaurant_id] -= 1
+                if not self._active[restaurant_id]:
+                    del self._active[restaurant_id]
+                job['status'] = status
+                job['finished_at'] = time.monotonic()
+
+    def _purge(self, now):
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['finished_at'] and now - job['finished_at'] > self.result_ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def metrics(self):
+        with self._lock:
+            started = self.completed + self.running
+            return {
+                'queue_depth': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'avg_wait_ms': round(self.total_wait / started * 1000, 1) if started else 0,
+                'max_wait_ms': round(self.max_wait * 1000, 1),
+            }
+
+
+advisor_jobs = AdvisorJobQueue(
+    max_workers=app.config['ADVISOR_WORKERS'],
+    max_queue=app.config['ADVISOR_QUEUE_SIZE'],
+    per_restaurant=app.config['ADVISOR_PER_RESTAURANT'],
+    result_ttl=app.config['ADVISOR_JOB_TTL']
+)
+
+
+def submit_advisor_job(restaurant_id, system_prompt, context, question):
+    """提交后台任务，返回 202 + 任务状态地址；队列满时返回 429"""
+    try:
+        job_id = advisor_jobs.submit(restaurant_id, current_user.id, system_prompt, context, question)
+    except QueueFull as e:
+        return jsonify({'error': str(e)}), 429
+    return jsonify({
+        'job_id': job_id,
+        'status_url': url_for('advisor_job_status', job_id=job_id)
+    }), 202
+
+
 # ----------------- 视图：认证 -----------------
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -660,18 +2120,17 @@ def register():
             return redirect(url_for('register'))
 
         try:
-            avatar_path = save_avatar(avatar_file)
-            if not avatar_path:
-                flash('头像上传失败，请重试', 'danger')
-                return redirect(url_for('register'))
+            staged_avatar = stage_upload(avatar_file, '头像')
         except ValueError as e:
             flash(str(e), 'danger')
             return redirect(url_for('register'))
 
-        user = User(username=username, email=None, avatar=avatar_path)
+        user = User(username=username, email=None, avatar_status='pending',
+                    avatar_job=os.path.basename(staged_avatar))
         user.set_password(password)
         db.session.add(user)
         db.session.commit()
+        enqueue_image_processing('avatar', user.id, staged_avatar)
         flash('注册成功，请登录', 'success')
         return redirect(url_for('login'))
 
@@ -741,6 +2200,12 @@ def manage_restaurant():
     restaurant = current_user.restaurant
 
     if request.method == 'POST' and not restaurant:
+        # 登录信息缓存可能还没看到刚在其他进程创建的餐厅，提交时以数据库为准
+        if Restaurant.query.filter_by(owner_id=current_user.id).first():
+            invalidate_user_cache(current_user.id)
+            flash('您已经创建过餐厅了', 'info')
+            return redirect(url_for('manage_restaurant'))
+
         # 创建餐厅
         name = request.form.get('name', '').strip()
         logo_file = request.files.get('logo')
@@ -758,14 +2223,27 @@ def manage_restaurant():
             return redirect(url_for('manage_restaurant'))
 
         try:
-            logo_path = save_logo(logo_file)
+            staged_logo = stage_upload(logo_file, 'Logo ')
         except ValueError as e:
             flash(str(e), 'danger')
             return redirect(url_for('manage_restaurant'))
 
-        restaurant = Restaurant(name=name, logo=logo_path, owner=current_user)
+        restaurant = Restaurant(name=name, logo_status='pending', logo_job=os.path.basename(staged_logo),
+                                owner_id=current_user.id)
+        restaurant.revenue_summary = RestaurantRevenue(order_count=0, revenue=0)
         db.session.add(restaurant)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 同一用户并发提交，或餐厅名称刚被占用
+            db.session.rollback()
+            os.remove(staged_logo)
+            invalidate_user_cache(current_user.id)
+            flash('餐厅创建失败：您已拥有餐厅或名称已被占用', 'danger')
+            return redirect(url_for('manage_restaurant'))
+        invalidate_user_cache(current_user.id)
+        current_user.restaurant_id = restaurant.id
+        enqueue_image_processing('logo', restaurant.id, staged_logo)
         create_default_categories(restaurant)
         flash('餐厅创建成功，接下来可以添加菜品啦～', 'success')
         return redirect(url_for('manage_restaurant'))
@@ -778,13 +2256,16 @@ def manage_restaurant():
 
 @app.route('/manage/dishes')
 @login_required
+@query_budget(4)
 def manage_dishes():
     restaurant = current_user.restaurant
     if not restaurant:
         flash('请先创建餐厅', 'warning')
         return redirect(url_for('manage_restaurant'))
 
-    categories = Category.query.filter_by(restaurant_id=restaurant.id).all()
+    # 一次性预加载所有分类下未下架的菜品，避免模板遍历 category.dishes 时逐个分类查询
+    categories = Category.query.options(selectinload(Category.dishes.and_(Dish.archived_at.is_(None))))\
+        .filter_by(restaurant_id=restaurant.id).all()
 
     # 每个菜品的统计：总份数、不同顾客数
     dish_stats = {}
@@ -794,7 +2275,7 @@ def manage_dishes():
         func.count(func.distinct(Order.customer_id)).label('user_count')
     ).join(OrderItem, OrderItem.dish_id == Dish.id, isouter=True)\
      .join(Order, OrderItem.order_id == Order.id, isouter=True)\
-     .filter(Dish.restaurant_id == restaurant.id)\
+     .filter(Dish.restaurant_id == restaurant.id, Dish.archived_at.is_(None))\
      .group_by(Dish.id).all()
     for did, qty, user_count in rows:
         dish_stats[did] = {'qty': qty or 0, 'user_count': user_count or 0}
@@ -847,7 +2328,7 @@ def add_dish(category_id):
             return redirect(request.url)
 
         try:
-            big_path, thumb_path = save_dish_images(image_file)
+            staged_image = stage_upload(image_file, '菜品图片')
         except ValueError as e:
             flash(str(e), 'danger')
             return redirect(request.url)
@@ -856,13 +2337,15 @@ def add_dish(category_id):
             name=name,
             description=description,
             price=price,
-            image=big_path,
-            thumb=thumb_path,
+            image_status='pending',
+            image_job=os.path.basename(staged_image),
             restaurant_id=restaurant.id,
             category_id=category.id
         )
         db.session.add(dish)
         db.session.commit()
+        enqueue_image_processing('dish', dish.id, staged_image)
+        invalidate_stats_cache(restaurant.id)
         flash('菜品添加成功', 'success')
         return redirect(url_for('manage_dishes'))
 
@@ -877,7 +2360,7 @@ def edit_dish(dish_id):
         flash('请先创建餐厅', 'warning')
         return redirect(url_for('manage_restaurant'))
 
-    dish = Dish.query.get_or_404(dish_id)
+    dish = get_active_dish_or_404(dish_id)
     if dish.restaurant_id != restaurant.id:
         flash('无权编辑其他餐厅的菜品', 'danger')
         return redirect(url_for('manage_dishes'))
@@ -907,16 +2390,21 @@ def edit_dish(dish_id):
         dish.price = price
         dish.description = description
 
+        # 新图片处理完成前继续显示旧图片
+        staged_image = None
         if image_file and image_file.filename:
             try:
-                big_path, thumb_path = save_dish_images(image_file)
+                staged_image = stage_upload(image_file, '菜品图片')
             except ValueError as e:
                 flash(str(e), 'danger')
                 return redirect(request.url)
-            dish.image = big_path
-            dish.thumb = thumb_path
+            dish.image_status = 'pending'
+            dish.image_job = os.path.basename(staged_image)
 
         db.session.commit()
+        if staged_image:
+            enqueue_image_processing('dish', dish.id, staged_image)
+        invalidate_stats_cache(restaurant.id)
         flash('菜品修改成功', 'success')
         return redirect(url_for('manage_dishes'))
 
@@ -931,38 +2419,18 @@ def delete_dish(dish_id):
         flash('请先创建餐厅', 'warning')
         return redirect(url_for('manage_restaurant'))
 
-    dish = Dish.query.get_or_404(dish_id)
+    dish = get_active_dish_or_404(dish_id)
     if dish.restaurant_id != restaurant.id:
         flash('无权删除其他餐厅的菜品', 'danger')
         return redirect(url_for('manage_dishes'))
 
-    # 获取所有包含该菜品的订单
-    affected_orders = db.session.query(Order).join(OrderItem).filter(
-        OrderItem.dish_id == dish.id
-    ).distinct().all()
-    
-    # 删除相关点餐记录（OrderItem）
-    OrderItem.query.filter_by(dish_id=dish.id).delete()
-    db.session.delete(dish)
-    db.session.commit()
-
-    # 重新计算受影响订单的总金额
-    for order in affected_orders:
-        # 重新计算该订单的总金额
-        new_total = db.session.query(
-            func.coalesce(func.sum(OrderItem.quantity * OrderItem.unit_price), 0)
-        ).filter(OrderItem.order_id == order.id).scalar() or Decimal('0.00')
-        order.total_amount = new_total
-    
-    db.session.commit()
-
-    # 清理空订单（没有订单项的订单）
-    empty_orders = Order.query.outerjoin(OrderItem).filter(OrderItem.id.is_(None)).all()
-    for od in empty_orders:
-        db.session.delete(od)
+    # 只标记下架：菜单和菜品管理中隐藏，订单和销量统计保持不变；
+    # 冷订单的归档和菜品的彻底删除由 archive-orders 在后台完成
+    dish.archived_at = datetime.utcnow()
     db.session.commit()
+    invalidate_stats_cache(restaurant.id)
 
-    flash('菜品及相关点餐记录已删除，订单总金额已更新', 'info')
+    flash('菜品已下架，历史订单保留不变', 'info')
     return redirect(url_for('manage_dishes'))
 
 
@@ -1021,7 +2489,8 @@ def manage_customers():
     return render_template(
         'manage_customers.html',
         restaurant=restaurant,
-        rows=rows
+        rows=rows,
+        blacklisted_ids=get_blacklisted_ids(restaurant.id)
     )
 
 
@@ -1066,14 +2535,16 @@ def toggle_blacklist(user_id):
         return redirect(url_for('manage_restaurant'))
 
     user = User.query.get_or_404(user_id)
-    if user in restaurant.blacklisted_users:
-        restaurant.blacklisted_users.remove(user)
+    entry = and_(blacklist_table.c.restaurant_id == restaurant.id, blacklist_table.c.user_id == user.id)
+    if db.session.execute(db.select(db.exists().where(entry))).scalar():
+        db.session.execute(blacklist_table.delete().where(entry))
         db.session.commit()
         flash(f'已将 {user.username} 从黑名单移除', 'info')
     else:
-        restaurant.blacklisted_users.append(user)
+        db.session.execute(blacklist_table.insert().values(restaurant_id=restaurant.id, user_id=user.id))
         db.session.commit()
         flash(f'已将 {user.username} 加入黑名单', 'warning')
+    invalidate_blacklist_cache(restaurant.id)
 
     return redirect(url_for('manage_customers'))
 
@@ -1159,20 +2630,8 @@ def manage_advisor():
         if not question:
             flash('请先输入要咨询的问题', 'warning')
         else:
-            stats_text = build_restaurant_stats_text(restaurant)
-            system_prompt = (
-                "你是一位经验丰富的餐厅经营顾问，擅长数据分析、市场洞察和经营策略制定。"
-                "你的回答应该：\n"
-                "1. 基于提供的真实统计数据进行分析，给出具体的数据支撑\n"
-                "2. 用简体中文、条理清晰地回答，使用分段和要点来组织内容\n"
-                "3. 如果问题涉及具体顾客或菜品，要引用数据中的具体信息（如姓名、金额、数量等）\n"
-                "4. 提供实用的建议和洞察，帮助老板做出更好的经营决策\n"
-                "5. 使用**粗体**来突出重要信息，使用*斜体*来强调次要信息\n"
-                "6. 回答要专业但友好，避免过于技术化的术语\n"
-                "7. 如果数据不足，要诚实说明，并给出基于经验的建议"
-            )
-            user_content = f"餐厅数据如下：\n{stats_text}\n\n老板的问题是：{question}"
-            answer = call_gpt(system_prompt, user_content)
+            context = build_advisor_context(restaurant)
+            answer = call_gpt_cached(ADVISOR_SYSTEM_PROMPT, context, question)
 
     return render_template(
         'manage_advisor.html',
@@ -1182,20 +2641,122 @@ def manage_advisor():
     )
 
 
+@app.route('/manage/advisor/stream', methods=['POST'])
+@login_required
+def manage_advisor_stream():
+    """经营顾问的流式版本（SSE），页面上通过 fetch 读取；不支持流式读取的浏览器走后台任务"""
+    restaurant = current_user.restaurant
+    question = request.form.get('question', '').strip()
+    if not restaurant or not question:
+        abort(400)
+
+    context = build_advisor_context(restaurant)
+    return sse_response(stream_gpt_answer(ADVISOR_SYSTEM_PROMPT, context, question))
+
+
+@app.route('/manage/advisor/jobs', methods=['POST'])
+@login_required
+def manage_advisor_job():
+    """经营顾问：提交后台任务，立即返回任务 ID"""
+    restaurant = current_user.restaurant
+    question = request.form.get('question', '').strip()
+    if not restaurant or not question:
+        abort(400)
+
+    context = build_advisor_context(restaurant)
+    return submit_advisor_job(restaurant.id, ADVISOR_SYSTEM_PROMPT, context, question)
+
+
+@app.route('/advisor/jobs/<job_id>')
+@login_required
+def advisor_job_status(job_id):
+    job = advisor_jobs.get(job_id)
+    if not job or job['user_id'] != current_user.id:
+        abort(404)
+    # 只返回 offset 之后新增的文本，完整 HTML 只在任务结束后返回，轮询总流量与答案长度成正比
+    text = job['text']
+    offset = min(max(request.args.get('offset', 0, type=int), 0), len(text))
+    finished = job['status'] in ('done', 'failed')
+    return jsonify({
+        'status': job['status'],
+        'text': text[offset:],
+        'offset': len(text),
+        'html': job['html'] if finished else '',
+    })
+
+
+@app.route('/advisor/metrics')
+@login_required
+def advisor_metrics():
+    """智能问答相关的运行指标：任务队列、GPT 客户端和各级缓存（仅餐厅老板可查看）"""
+    if not current_user.restaurant:
+        abort(403)
+    return jsonify({
+        'jobs': advisor_jobs.metrics(),
+        'gpt': gpt_client.stats(),
+        'answer_cache': answer_cache.stats(),
+        'format_cache': format_cache.stats(),
+        'stats_cache': stats_cache.stats(),
+    })
+
+
 # ----------------- 视图：点餐部分 -----------------
 
+def parse_restaurant_cursor(cursor):
+    """解析餐厅列表游标 "销售额_餐厅ID"，格式不对时返回 None（即从第一页开始）"""
+    if not cursor:
+        return None
+    try:
+        revenue_str, rid_str = cursor.rsplit('_', 1)
+        return Decimal(revenue_str), int(rid_str)
+    except (ValueError, ArithmeticError):
+        return None
+
+
+def make_restaurant_cursor(revenue, restaurant_id):
+    return f"{Decimal(revenue):.2f}_{restaurant_id}"
+
+
 @app.route('/restaurants')
 @login_required
 def restaurants():
-    # 按销售额排序
-    rows = db.session.query(
-        Restaurant,
-        func.coalesce(func.sum(Order.total_amount), 0).label('revenue')
-    ).outerjoin(Order, Order.restaurant_id == Restaurant.id)\
-     .group_by(Restaurant.id)\
-     .order_by(func.sum(Order.total_amount).desc()).all()
+    # 按销售额排序，基于 (revenue, restaurant_id) 的游标分页：
+    # 每页只顺着汇总表索引读 per_page + 1 行，与餐厅总数无关
+    per_page = request.args.get('per_page', app.config['RESTAURANTS_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, app.config['RESTAURANTS_MAX_PER_PAGE']))
+    prefix = request.args.get('q', '').strip()
+    cursor = parse_restaurant_cursor(request.args.get('after'))
+
+    query = db.session.query(Restaurant, RestaurantRevenue.revenue)\
+        .join(RestaurantRevenue, RestaurantRevenue.restaurant_id == Restaurant.id)
+    if prefix:
+        query = query.filter(Restaurant.name.startswith(prefix, autoescape=True))
+    if cursor:
+        last_revenue, last_id = cursor
+        query = query.filter(or_(
+            RestaurantRevenue.revenue < last_revenue,
+            and_(RestaurantRevenue.revenue == last_revenue,
+                 RestaurantRevenue.restaurant_id < last_id)
+        ))
+    rows = query.order_by(
+        RestaurantRevenue.revenue.desc(),
+        RestaurantRevenue.restaurant_id.desc()
+    ).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last_restaurant, last_revenue = rows[-1]
+        next_cursor = make_restaurant_cursor(last_revenue, last_restaurant.id)
 
-    return render_template('restaurants_list.html', rows=rows)
+    return render_template(
+        'restaurants_list.html',
+        rows=rows,
+        q=prefix,
+        per_page=per_page,
+        is_first_page=cursor is None,
+        next_cursor=next_cursor
+    )
 
 
 @app.route('/restaurant/<int:restaurant_id>')
@@ -1216,7 +2777,8 @@ def restaurant_menu(restaurant_id):
     if selected_category_id:
         dishes = Dish.query.filter_by(
             restaurant_id=restaurant.id,
-            category_id=selected_category_id
+            category_id=selected_category_id,
+            archived_at=None
         ).all()
 
     return render_template(
@@ -1232,7 +2794,7 @@ def restaurant_menu(restaurant_id):
 @login_required
 def dish_detail(restaurant_id, dish_id):
     restaurant = Restaurant.query.get_or_404(restaurant_id)
-    dish = Dish.query.get_or_404(dish_id)
+    dish = get_active_dish_or_404(dish_id)
     if dish.restaurant_id != restaurant.id:
         flash('该菜品不属于当前餐厅', 'danger')
         return redirect(url_for('restaurant_menu', restaurant_id=restaurant_id))
@@ -1247,24 +2809,8 @@ def dish_detail(restaurant_id, dish_id):
         if not question:
             flash('请输入想要咨询的问题', 'warning')
         else:
-            menu_text = build_menu_stats_text(restaurant)
-            system_prompt = (
-                "你是一位专业的餐厅点餐顾问，擅长帮助顾客选择适合的菜品。"
-                "你的回答应该：\n"
-                "1. 优先围绕顾客当前浏览的菜品回答，但如果顾客明确提到其他菜品，要综合考虑整个菜单\n"
-                "2. 使用简体中文，语气友好、亲切，像朋友一样给出建议\n"
-                "3. 结合菜品数据（价格、被点次数、评价等）来回答，让建议更有说服力\n"
-                "4. 如果顾客询问菜品特点、搭配建议、口味等，要基于菜单信息给出具体建议\n"
-                "5. 使用**粗体**来突出重要信息，使用*斜体*来强调次要信息\n"
-                "6. 回答要简洁明了，避免冗长，但要有足够的信息帮助顾客做决定\n"
-                "7. 如果数据不足，可以基于菜品名称和分类给出合理的建议"
-            )
-            user_content = (
-                f"完整菜单和销售数据如下：\n{menu_text}\n\n"
-                f"顾客当前正在查看的菜品是：{dish.name}（ID: {dish.id}）。\n"
-                f"顾客的问题是：{question}"
-            )
-            answer = call_gpt(system_prompt, user_content)
+            context = build_dish_advisor_context(restaurant, dish)
+            answer = call_gpt_cached(DISH_ADVISOR_SYSTEM_PROMPT, context, question)
 
     return render_template(
         'dish_detail.html',
@@ -1275,20 +2821,51 @@ def dish_detail(restaurant_id, dish_id):
     )
 
 
+@app.route('/restaurant/<int:restaurant_id>/dish/<int:dish_id>/ask/stream', methods=['POST'])
+@login_required
+def dish_detail_stream(restaurant_id, dish_id):
+    """菜品顾问的流式版本（SSE），页面上通过 fetch 读取；不支持流式读取的浏览器走后台任务"""
+    restaurant = Restaurant.query.get_or_404(restaurant_id)
+    dish = get_active_dish_or_404(dish_id)
+    question = request.form.get('question', '').strip()
+    if dish.restaurant_id != restaurant.id or not question:
+        abort(400)
+
+    context = build_dish_advisor_context(restaurant, dish)
+    return sse_response(stream_gpt_answer(DISH_ADVISOR_SYSTEM_PROMPT, context, question))
+
+
+@app.route('/restaurant/<int:restaurant_id>/dish/<int:dish_id>/ask/jobs', methods=['POST'])
+@login_required
+def dish_detail_job(restaurant_id, dish_id):
+    """菜品顾问：提交后台任务，立即返回任务 ID"""
+    restaurant = Restaurant.query.get_or_404(restaurant_id)
+    dish = get_active_dish_or_404(dish_id)
+    question = request.form.get('question', '').strip()
+    if dish.restaurant_id != restaurant.id or not question:
+        abort(400)
+
+    context = build_dish_advisor_context(restaurant, dish)
+    return submit_advisor_job(restaurant.id, DISH_ADVISOR_SYSTEM_PROMPT, context, question)
+
+
 @app.route('/add_to_cart/<int:dish_id>', methods=['POST'])
 @login_required
 def add_to_cart_route(dish_id):
-    dish = Dish.query.get_or_404(dish_id)
+    dish = get_active_dish_or_404(dish_id)
     restaurant = dish.restaurant
 
     if is_blacklisted(restaurant, current_user):
         flash('抱歉，您已被本餐厅加入黑名单，无法下单。', 'danger')
         return redirect(request.referrer or url_for('restaurant_menu', restaurant_id=restaurant.id))
 
-    quantity = request.form.get('quantity', 1, type=int)
-    if quantity <= 0:
-        quantity = 1
-    add_to_cart(dish_id, quantity)
+    quantity = parse_cart_quantity(request.form.get('quantity', 1), minimum=1) or 1
+    current = cart_store.items(current_user.id, restaurant.id).get(dish.id, 0)
+    if current + quantity > CART_MAX_QUANTITY:
+        flash(f'每道菜最多 {CART_MAX_QUANTITY} 份', 'warning')
+        return redirect(request.referrer or url_for('restaurant_menu', restaurant_id=restaurant.id))
+    add_to_cart(dish, quantity)
+    db.session.commit()
     flash(f'已将 {dish.name} 加入您的餐桌', 'success')
     return redirect(request.referrer or url_for('restaurant_menu', restaurant_id=restaurant.id))
 
@@ -1312,32 +2889,132 @@ def my_table(restaurant_id):
 @app.route('/update_cart/<int:restaurant_id>/<int:dish_id>', methods=['POST'])
 @login_required
 def update_cart(restaurant_id, dish_id):
-    dish = Dish.query.get_or_404(dish_id)
+    dish = get_active_dish_or_404(dish_id)
     if dish.restaurant_id != restaurant_id:
         flash('菜品不属于该餐厅', 'danger')
         return redirect(url_for('my_table', restaurant_id=restaurant_id))
 
-    cart = get_cart()
-    rid = str(restaurant_id)
-    did = str(dish_id)
     action = request.form.get('action')
 
-    if rid not in cart or did not in cart[rid]:
+    items = cart_store.items(current_user.id, restaurant_id)
+    if dish_id not in items:
         flash('您的餐桌中没有该菜品', 'warning')
         return redirect(url_for('my_table', restaurant_id=restaurant_id))
 
+    # 数量减到 0 时保留在购物车中；与 JSON 接口一样每道菜最多 CART_MAX_QUANTITY 份
     if action == 'inc':
-        cart[rid][did] += 1
+        if items[dish_id] >= CART_MAX_QUANTITY:
+            flash(f'每道菜最多 {CART_MAX_QUANTITY} 份', 'warning')
+            return redirect(url_for('my_table', restaurant_id=restaurant_id))
+        cart_store.incr(current_user.id, restaurant_id, dish_id, 1)
     elif action == 'dec':
-        cart[rid][did] -= 1
-        # 不再删除数量为0的菜品，保留在购物车中
-        if cart[rid][did] < 0:
-            cart[rid][did] = 0
+        cart_store.incr(current_user.id, restaurant_id, dish_id, -1)
+    db.session.commit()
 
-    save_cart(cart)
     return redirect(url_for('my_table', restaurant_id=restaurant_id))
 
 
+@app.route('/api/cart/<int:restaurant_id>/<int:dish_id>', methods=['POST'])
+@login_required
+def cart_line_api(restaurant_id, dish_id):
+    """购物车 JSON 接口：action 为 add / inc / dec / set，只返回变化的这一行和新的总价"""
+    data = request.get_json(silent=True) if request.is_json else request.form
+    if not isinstance(data, Mapping):
+        return jsonify({'error': '请求格式不正确'}), 400
+    action = data.get('action')
+    if action not in ('add', 'inc', 'dec', 'set'):
+        return jsonify({'error': '不支持的操作'}), 400
+    minimum = 1 if action == 'add' else 0
+    quantity = parse_cart_quantity(data.get('quantity', 1), minimum)
+    if quantity is None:
+        return jsonify({'error': f'数量必须是 {minimum}～{CART_MAX_QUANTITY} 的整数'}), 400
+
+    dish = db.session.get(Dish, dish_id)
+    if not dish or dish.restaurant_id != restaurant_id or dish.archived_at:
+        return jsonify({'error': '菜品不存在'}), 404
+
+    uid = current_user.id
+    current = cart_store.items(uid, restaurant_id).get(dish_id)
+    if action in ('add', 'inc') and (current or 0) + (quantity if action == 'add' else 1) > CART_MAX_QUANTITY:
+        return jsonify({'error': f'每道菜最多 {CART_MAX_QUANTITY} 份'}), 400
+    if action in ('add', 'set'):
+        if is_blacklisted(dish.restaurant, current_user):
+            return jsonify({'error': '抱歉，您已被本餐厅加入黑名单，无法下单。'}), 403
+        if action == 'add':
+            qty = cart_store.incr(uid, restaurant_id, dish_id, quantity)
+        else:
+            qty = cart_store.set(uid, restaurant_id, dish_id, quantity)
+    else:
+        if current is None:
+            return jsonify({'error': '您的餐桌中没有该菜品'}), 404
+        qty = cart_store.incr(uid, restaurant_id, dish_id, 1 if action == 'inc' else -1)
+    db.session.commit()
+
+    line_total = Decimal(str(dish.price)) * qty
+    return jsonify({
+        'dish_id': dish_id,
+        'quantity': qty,
+        'line_total': '%.2f' % line_total,
+        'total': '%.2f' % get_cart_total(restaurant_id),
+    })
+
+
+CART_BATCH_MAX_ITEMS = 100
+
+
+@app.route('/api/cart/<int:restaurant_id>/batch', methods=['POST'])
+@login_required
+def cart_batch_api(restaurant_id):
+    """一次加入多道菜：{"items": [{"dish_id": 1, "quantity": 2}, ...]}，
+    全部校验通过后一次性写入购物车，任何一项不合法都不做修改"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': '请求格式不正确'}), 400
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': '请提供要加入的菜品列表'}), 400
+    if len(items) > CART_BATCH_MAX_ITEMS:
+        return jsonify({'error': f'一次最多加入 {CART_BATCH_MAX_ITEMS} 项'}), 400
+
+    # 同一道菜出现多次时数量累加
+    deltas = {}
+    for entry in items:
+        if not isinstance(entry, dict):
+            return jsonify({'error': '菜品或数量格式不正确'}), 400
+        dish_id = entry.get('dish_id')
+        if isinstance(dish_id, bool) or not isinstance(dish_id, int) or not 0 < dish_id < 2 ** 31:
+            return jsonify({'error': '菜品或数量格式不正确'}), 400
+        quantity = parse_cart_quantity(entry.get('quantity', 1), minimum=1)
+        if quantity is None:
+            return jsonify({'error': f'数量必须是 1～{CART_MAX_QUANTITY} 的整数'}), 400
+        deltas[dish_id] = deltas.get(dish_id, 0) + quantity
+
+    restaurant = db.session.get(Restaurant, restaurant_id)
+    if not restaurant:
+        return jsonify({'error': '餐厅不存在'}), 404
+    if is_blacklisted(restaurant, current_user):
+        return jsonify({'error': '抱歉，您已被本餐厅加入黑名单，无法下单。'}), 403
+
+    found = {dish_id for dish_id, in db.session.query(Dish.id).filter(
+        Dish.id.in_(list(deltas)), Dish.restaurant_id == restaurant_id, Dish.archived_at.is_(None)
+    )}
+    missing = sorted(set(deltas) - found)
+    if missing:
+        return jsonify({'error': '菜品不存在', 'dish_ids': missing}), 404
+    current = cart_store.items(current_user.id, restaurant_id)
+    too_many = sorted(d for d, qty in deltas.items() if current.get(d, 0) + qty > CART_MAX_QUANTITY)
+    if too_many:
+        return jsonify({'error': f'每道菜最多 {CART_MAX_QUANTITY} 份', 'dish_ids': too_many}), 400
+
+    cart_store.incr_many(current_user.id, restaurant_id, deltas)
+    db.session.commit()
+    quantities = cart_store.items(current_user.id, restaurant_id)
+    return jsonify({
+        'items': [{'dish_id': dish_id, 'quantity': quantities.get(dish_id, 0)} for dish_id in deltas],
+        'total': '%.2f' % get_cart_total(restaurant_id),
+    })
+
+
 @app.route('/restaurant/<int:restaurant_id>/checkout', methods=['POST'])
 @login_required
 def checkout(restaurant_id):
@@ -1375,14 +3052,11 @@ def checkout(restaurant_id):
             )
             db.session.add(item)
 
+    record_restaurant_order(order)
+    # 清空该餐厅的购物车（数据库后端与订单在同一事务提交）
+    cart_store.clear(current_user.id, restaurant_id)
     db.session.commit()
-
-    # 清空该餐厅的购物车
-    cart = get_cart()
-    rid = str(restaurant_id)
-    if rid in cart:
-        del cart[rid]
-        save_cart(cart)
+    invalidate_stats_cache(restaurant_id)
 
     flash('付款成功，祝您用餐愉快！', 'success')
     return render_template(
@@ -1394,17 +3068,305 @@ def checkout(restaurant_id):
     )
 
 
+# ----------------- 视图：上传图片 -----------------
+
+@app.route('/media/<fingerprint>/<path:filename>')
+def media(fingerprint, filename):
+    """提供上传图片：指纹与当前文件一致时允许浏览器长期缓存且不再校验；
+    ETag / Last-Modified / Range 由 send_from_directory 处理"""
+    upload_dir = app.config['UPLOAD_FOLDER']
+    full_path = safe_join(upload_dir, filename)
+    if full_path is None or not os.path.isfile(full_path):
+        abort(404)
+
+    # 指纹对不上的旧地址（早期按修改时间生成的指纹）只允许协商缓存
+    fresh = fingerprint == media_fingerprint(filename)
+    if app.config['MEDIA_ACCEL_PREFIX']:
+        # 交给 nginx 发送文件，条件请求和 Range 也由 nginx 处理
+        response = Response()
+        response.headers['X-Accel-Redirect'] = f"{app.config['MEDIA_ACCEL_PREFIX']}/{filename}"
+        response.headers.pop('Content-Type', None)
+    else:
+        response = send_from_directory(
+            upload_dir, filename, conditional=True, etag=True,
+            max_age=app.config['MEDIA_MAX_AGE'] if fresh else None,
+        )
+
+    if fresh:
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['MEDIA_MAX_AGE']
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
 # ----------------- CLI & 入口 -----------------
 
+def add_missing_columns():
+    """给已有数据库的表补上模型里新增的列（create_all 不会修改已存在的表），返回补上的列名"""
+    inspector = inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.quote
+    added = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {col['name'] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            col_type = column.type.compile(dialect=db.engine.dialect)
+            db.session.execute(text(
+                f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {col_type}'
+            ))
+            added.append(f'{table.name}.{column.name}')
+    db.session.commit()
+    return added
+
+
+def add_missing_indexes():
+    """给已有数据库补上模型里声明的索引（可重复执行），返回新建的索引名"""
+    inspector = inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(bind=db.engine)
+            except IntegrityError as e:
+                # 唯一索引：已有数据重复（如同一用户有多家餐厅），需人工处理后再执行
+                print("Create index error:", index.name, repr(e))
+                continue
+            created.append(index.name)
+    return created
+
+
+# 这些表数据量随订单增长，视图查询不应全表扫描
+QUERY_PLAN_HOT_TABLES = {'order', 'order_item', 'dish', 'category', 'cart_item', 'restaurant'}
+
+
+def collect_view_query_plans():
+    """以订单最多的餐厅老板身份请求主要只读页面，记录执行的 SELECT，
+    返回 [(页面, SQL, 全表扫描的表)]；仅支持 SQLite 的 EXPLAIN QUERY PLAN"""
+    summary = RestaurantRevenue.query.order_by(RestaurantRevenue.order_count.desc()).first()
+    restaurant = db.session.get(Restaurant, summary.restaurant_id) if summary else Restaurant.query.first()
+    if not restaurant:
+        return []
+    dish = Dish.query.filter_by(restaurant_id=restaurant.id).first()
+    order = Order.query.filter_by(restaurant_id=restaurant.id).first()
+
+    paths = ['/dashboard', '/restaurants', '/manage/restaurant', '/manage/dishes',
+             '/manage/customers', '/manage/reports', '/manage/advisor',
+             f'/restaurant/{restaurant.id}', f'/restaurant/{restaurant.id}/my_table']
+    if dish:
+        paths += [f'/manage/dish/{dish.id}', f'/restaurant/{restaurant.id}/dish/{dish.id}']
+    if order:
+        paths.append(f'/manage/customer/{order.customer_id}')
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            captured.append((request.path, statement, parameters))
+
+    # 清掉登录信息缓存，让 load_user 的关联查询也被记录
+    invalidate_user_cache(restaurant.owner_id)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(restaurant.owner_id)
+        sess['_fresh'] = True
+    event.listen(Engine, 'before_cursor_execute', capture)
+    try:
+        for path in paths:
+            client.get(path)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', capture)
+
+    results = []
+    seen = set()
+    cursor = db.session.connection().connection.cursor()
+    for path, statement, parameters in captured:
+        if statement in seen:
+            continue
+        seen.add(statement)
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        # 形如 "SCAN order"；"SEARCH ... USING INDEX" 和 "SCAN ... USING COVERING INDEX" 都走了索引
+        scanned = sorted({
+            detail.split()[1].strip('"') for *_, detail in cursor.fetchall()
+            if detail.startswith('SCAN ') and ' USING ' not in detail
+            and detail.split()[1].strip('"') in QUERY_PLAN_HOT_TABLES
+        })
+        results.append((path, statement, scanned))
+    return results
+
+
 @app.cli.command('init-db')
 def init_db_cmd():
     """初始化数据库"""
     db.create_all()
+    for name in add_missing_columns():
+        print(f"已添加列 {name}")
+    for name in add_missing_indexes():
+        print(f"已创建索引 {name}")
+    count = backfill_restaurant_revenue()
+    if count:
+        print(f"已补建 {count} 家餐厅的销售额汇总")
     print("数据库已初始化。")
 
 
+@app.cli.command('create-indexes')
+def create_indexes_cmd():
+    """给已有数据库补建模型中声明的索引，可重复执行"""
+    created = add_missing_indexes()
+    for name in created:
+        print(f"已创建索引 {name}")
+    print(f"共新建 {len(created)} 个索引。")
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans_cmd():
+    """检查主要页面的查询是否走索引，有全表扫描时以非零状态退出（仅 SQLite）"""
+    if db.engine.dialect.name != 'sqlite':
+        print("EXPLAIN QUERY PLAN 检查只支持 SQLite。")
+        return
+    results = collect_view_query_plans()
+    if not results:
+        print("数据库里没有餐厅，先执行 generate_test_data.py 生成测试数据。")
+        return
+    bad = [(path, statement, scanned) for path, statement, scanned in results if scanned]
+    for path, statement, scanned in bad:
+        print(f"[全表扫描 {', '.join(scanned)}] {path}\n  {' '.join(statement.split())}")
+    print(f"共检查 {len(results)} 条查询，{len(bad)} 条全表扫描。")
+    if bad:
+        raise SystemExit(1)
+
+
+@app.cli.command('rebuild-revenue')
+def rebuild_revenue_cmd():
+    """根据订单表重建餐厅销售额汇总"""
+    count = rebuild_restaurant_revenue()
+    print(f"已重建 {count} 家餐厅的销售额汇总。")
+
+
+@app.cli.command('archive-orders')
+@click.option('--days', type=int, default=None, help='归档多少天以前的订单，默认 ORDER_ARCHIVE_AFTER_DAYS')
+@click.option('--batch-size', type=int, default=500, show_default=True, help='每批提交的订单项数')
+@click.option('--dry-run', is_flag=True, help='只统计，不修改')
+def archive_orders_cmd(days, batch_size, dry_run):
+    """把冷订单中下架菜品的订单项移入 order_item_history，并删除已无订单项引用的下架菜品（适合定时任务执行）"""
+    days = app.config['ORDER_ARCHIVE_AFTER_DAYS'] if days is None else days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    moved, purged = archive_cold_order_items(cutoff, batch_size=batch_size, dry_run=dry_run)
+    if dry_run:
+        print(f"可归档 {moved} 个订单项，可删除 {purged} 个下架菜品。")
+    else:
+        print(f"已归档 {moved} 个订单项，删除 {purged} 个下架菜品。")
+
+
+@app.cli.command('sweep-image-jobs')
+@click.option('--minutes', type=int, default=30, show_default=True,
+              help='pending 超过多少分钟视为处理进程已退出')
+@click.option('--dry-run', is_flag=True, help='只统计，不修改')
+def sweep_image_jobs_cmd(minutes, dry_run):
+    """重新处理或标记失败长时间停在 pending 的图片，并删除遗留的暂存原图（适合启动时或定时执行）"""
+    requeued, failed, removed = sweep_image_jobs(timedelta(minutes=minutes), dry_run=dry_run)
+    if dry_run:
+        print(f"可重新处理 {requeued} 张，标记失败 {failed} 张，可删除 {removed} 个暂存文件。")
+    else:
+        print(f"已重新处理 {requeued} 张，标记失败 {failed} 张，删除 {removed} 个暂存文件。")
+
+
+@app.cli.command('gc-media')
+@click.option('--dry-run', is_flag=True, help='只统计，不删除')
+def gc_media_cmd(dry_run):
+    """清理不再被任何数据行引用的上传图片"""
+    blobs, files = gc_media_blobs(dry_run=dry_run)
+    if dry_run:
+        print(f"可清理 {blobs} 条图片记录，共 {files} 个文件。")
+    else:
+        print(f"已清理 {blobs} 条图片记录，删除 {files} 个文件。")
+
+
+@app.cli.command('rederive-media')
+@click.option('--kind', 'kinds', multiple=True, type=click.Choice(REDERIVE_KINDS),
+              help='只处理指定类型，可重复；默认全部')
+@click.option('--workers', type=int, default=None, help='进程数，默认 CPU 核数')
+@click.option('--rate', type=float, default=0, help='每秒最多提交多少张，0 表示不限')
+@click.option('--checkpoint', default=os.path.join(BASE_DIR, 'rederive_media.checkpoint'),
+              show_default=True, help='进度文件，中断后再次执行会跳过已完成的图片')
+@click.option('--restart', is_flag=True, help='忽略已有进度从头开始')
+@click.option('--dry-run', is_flag=True, help='只统计待处理的图片，不生成文件')
+def rederive_media_cmd(kinds, workers, rate, checkpoint, restart, dry_run):
+    """调整图片尺寸或格式后，为已有的菜品图片重新生成缩略图和响应式变体"""
+    kinds = kinds or REDERIVE_KINDS
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    done = set()
+    if os.path.exists(checkpoint):
+        with open(checkpoint, encoding='utf-8') as f:
+            done = {line.rstrip('\n') for line in f if line.strip()}
+
+    tasks = [(kind, path) for kind in kinds for path in list_media_paths(kind)
+             if f'{kind}\t{path}' not in done]
+    if dry_run:
+        for kind in kinds:
+            print(f"{kind}: {sum(1 for k, _ in tasks if k == kind)} 张待处理")
+        print(f"共 {len(tasks)} 张，已完成 {len(done)} 张（进度文件 {checkpoint}）")
+        return
+
+    workers = workers or os.cpu_count() or 1
+    interval = 1 / rate if rate > 0 else 0
+    succeeded = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool, \
+            open(checkpoint, 'a', encoding='utf-8') as progress:
+        pending = {}
+        next_submit = time.monotonic()
+        task_iter = iter(tasks)
+        while True:
+            # 在途任务控制在进程数的两倍以内，避免一次性提交十万个任务占满内存
+            while len(pending) < workers * 2:
+                task = next(task_iter, None)
+                if task is None:
+                    break
+                if interval:
+                    delay = next_submit - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_submit = max(next_submit, time.monotonic()) + interval
+                pending[pool.submit(rederive_media, *task)] = task
+            if not pending:
+                break
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                kind, path = pending.pop(future)
+                try:
+                    apply_rederived_media(kind, path, future.result())
+                except Exception as e:
+                    db.session.rollback()
+                    print("Rederive media error:", path, repr(e))
+                    failed += 1
+                    continue
+                progress.write(f'{kind}\t{path}\n')
+                progress.flush()
+                succeeded += 1
+                if succeeded % 100 == 0:
+                    print(f"已处理 {succeeded}/{len(tasks)} 张")
+
+    print(f"完成：成功 {succeeded} 张，失败 {failed} 张。")
+    if not failed:
+        os.remove(checkpoint)
+
+
 if __name__ == '__main__':
     ensure_upload_dirs()
     with app.app_context():
         db.create_all()
+        add_missing_columns()
+        add_missing_indexes()
+        backfill_restaurant_revenue()
     app.run(host='0.0.0.0', port=5001, debug=True)
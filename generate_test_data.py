@@ -17,7 +17,7 @@ import math
 # 添加项目路径
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from app import app, db, User, Restaurant, Category, Dish, Order, OrderItem
+from app import app, db, User, Restaurant, Category, Dish, Order, OrderItem, rebuild_restaurant_revenue
 from werkzeug.security import generate_password_hash
 
 # 菜品名称和分类
@@ -624,6 +624,7 @@ def create_test_orders(users, restaurants):
             total_orders += 1
     
     db.session.commit()
+    rebuild_restaurant_revenue()
     print(f"[OK] 创建了 {total_orders} 个订单\n")
     return total_orders
 
@@ -0,0 +1,148 @@
+// 智能顾问：优先用 SSE 流式读取回答，浏览器不支持流式读取时提交为后台任务并轮询结果。
+// 生成过程中服务端只发送新增的文本，页面先按纯文本追加显示，结束后一次性换成格式化好的 HTML。
+// 网络或服务出错时只提示错误，不再退回普通表单提交（否则会重复调用一次 GPT）。
+function initAdvisorJob(options) {
+    const form = document.getElementById(options.formId);
+    if (!form || !window.fetch) {
+        return;
+    }
+    const questionInput = document.getElementById(options.inputId);
+    const submitBtn = document.getElementById(options.submitId);
+    const loadingIndicator = document.getElementById(options.loadingId);
+    const answerSection = document.getElementById(options.sectionId);
+    const answerBox = document.getElementById(options.answerId);
+    const buttonHtml = submitBtn.innerHTML;
+    const canStream = options.streamUrl && window.ReadableStream && window.TextDecoder;
+    let liveText = null;
+
+    function resetButton() {
+        submitBtn.disabled = false;
+        submitBtn.innerHTML = buttonHtml;
+        loadingIndicator.style.display = 'none';
+    }
+
+    function showAnswer(html) {
+        loadingIndicator.style.display = 'none';
+        answerSection.style.display = 'block';
+        answerBox.innerHTML = html;
+        liveText = null;
+    }
+
+    function appendText(text) {
+        if (!text) {
+            return;
+        }
+        if (!liveText) {
+            showAnswer('');
+            liveText = document.createElement('div');
+            liveText.style.whiteSpace = 'pre-wrap';
+            answerBox.appendChild(liveText);
+        }
+        liveText.appendChild(document.createTextNode(text));
+    }
+
+    function showMessage(cls, text) {
+        const p = document.createElement('p');
+        p.className = cls + ' mb-0';
+        p.textContent = text;
+        showAnswer('');
+        answerBox.appendChild(p);
+    }
+
+    async function showRejection(resp) {
+        const data = await resp.json().catch(() => ({}));
+        showMessage('text-warning', data.error || '提问的人太多了，请稍后再试');
+    }
+
+    function handleEvent(name, data) {
+        if (name === 'delta') {
+            appendText(data.text);
+        } else if (name === 'answer' || name === 'error') {
+            showAnswer(data.html);
+        }
+    }
+
+    async function askStreaming() {
+        const resp = await fetch(options.streamUrl, {method: 'POST', body: new FormData(form)});
+        if (resp.status === 429) {
+            return showRejection(resp);
+        }
+        if (!resp.ok || !resp.body) {
+            throw new Error('stream failed: ' + resp.status);
+        }
+        const reader = resp.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const {value, done} = await reader.read();
+            if (done) {
+                return;
+            }
+            buffer += decoder.decode(value, {stream: true});
+            let end;
+            while ((end = buffer.indexOf('\n\n')) !== -1) {
+                const block = buffer.slice(0, end);
+                buffer = buffer.slice(end + 2);
+                let name = 'message';
+                let data = '';
+                for (const line of block.split('\n')) {
+                    if (line.startsWith('event: ')) {
+                        name = line.slice(7);
+                    } else if (line.startsWith('data: ')) {
+                        data += line.slice(6);
+                    }
+                }
+                if (name === 'done') {
+                    return;
+                }
+                handleEvent(name, data ? JSON.parse(data) : {});
+            }
+        }
+    }
+
+    async function askInBackground() {
+        const resp = await fetch(options.jobUrl, {method: 'POST', body: new FormData(form)});
+        if (resp.status === 429) {
+            return showRejection(resp);
+        }
+        if (!resp.ok) {
+            throw new Error('submit failed: ' + resp.status);
+        }
+        const data = await resp.json();
+        let offset = 0;
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, 500));
+            // 只取上次之后新增的文本
+            const poll = await fetch(data.status_url + '?offset=' + offset);
+            if (!poll.ok) {
+                throw new Error('poll failed: ' + poll.status);
+            }
+            const job = await poll.json();
+            appendText(job.text);
+            offset = job.offset;
+            if (job.status === 'done' || job.status === 'failed') {
+                showAnswer(job.html);
+                return;
+            }
+        }
+    }
+
+    form.addEventListener('submit', function(e) {
+        // 空问题照常提交，由服务端提示
+        if (!questionInput || !questionInput.value.trim()) {
+            return;
+        }
+        e.preventDefault();
+        if (submitBtn.disabled) {
+            return;
+        }
+        submitBtn.disabled = true;
+        submitBtn.innerHTML = '<span class="spinner-border spinner-border-sm me-1"></span>' + options.busyText;
+        loadingIndicator.style.display = 'block';
+        answerBox.innerHTML = '';
+        liveText = null;
+        (canStream ? askStreaming() : askInBackground()).catch(function() {
+            showMessage('text-danger', '获取回答失败，请检查网络后重试');
+        }).finally(resetButton);
+    });
+}